@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# import_time.py
+# Measures what importing Alpaca costs before the window can be shown, using python's -X importtime, and lists
+# the modules that took the longest. With --check it exits with an error when the import goes over the budget
+# or loads a module that should only be loaded when it's used, run it from the repository root after building:
+#   python3 benchmarks/import_time.py [--budget 250] [--runs 5] [--top 15] [--check]
+import argparse, glob, os, subprocess, sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# Loaded on first use by the window, importing them at startup is a regression
+lazy_modules = ["PIL", "requests", "webbrowser", "src.available_models", "gi.repository.GtkSource"]
+resource_paths = ["_build/src/alpaca.gresource", "build/src/alpaca.gresource", "builddir/src/alpaca.gresource", "/app/share/alpaca/alpaca.gresource"]
+
+startup = """
+import gettext, gi
+gettext.install('alpaca')
+from gi.repository import Gio
+Gio.Resource.load({resource!r})._register()
+import src.main
+"""
+
+def find_resource() -> str:
+    for path in resource_paths:
+        for match in glob.glob(os.path.join(root, path)): return match
+    return None
+
+def measure(resource:str) -> dict:
+    # {module: (self, cumulative)} in microseconds for a fresh interpreter
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", startup.format(resource=resource)], cwd=root, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().split("\n")[-1])
+    modules = {}
+    for line in process.stderr.split("\n"):
+        if not line.startswith("import time:") or "[us]" in line: continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_time), int(cumulative))
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=250, help="milliseconds importing src.main may take")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--resource", default=None, help="compiled alpaca.gresource, found in the build directory by default")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+
+    resource = args.resource or find_resource()
+    if not resource:
+        print("alpaca.gresource not found, build the project or pass --resource")
+        return 2
+    try: runs = [measure(resource) for _ in range(args.runs)]
+    except RuntimeError as e:
+        print(f"Importing Alpaca failed: {e}")
+        return 2
+    # Best run of every module so a busy machine doesn't count against the budget
+    modules = {name: min(run[name] for run in runs if name in run) for name in runs[0]}
+    total = modules["src.main"][1] / 1000
+
+    print(f"src.main: {total:.1f} ms (budget {args.budget:.0f} ms, best of {args.runs})")
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    for name, (self_time, cumulative) in sorted(modules.items(), key=lambda item: item[1][1], reverse=True)[:args.top]:
+        print(f"{cumulative / 1000:>9.1f} ms {self_time / 1000:>7.1f} ms  {name}")
+
+    loaded = [name for name in lazy_modules if name in modules]
+    if loaded: print(f"Loaded at startup but should be loaded on first use: {', '.join(loaded)}")
+    if args.check and (total > args.budget or loaded):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# stream_decode.py
+# Compares the old line by line decoding of Ollama's NDJSON streams with connection_handler.iter_ndjson
+# on a synthetic 10k token chat stream, and counts the batches iter_body makes from Ollama's one chunk per token
+# HTTP responses, run it from the repository root:
+#   python3 benchmarks/stream_decode.py [--tokens 10000] [--runs 5]
+import argparse, asyncio, io, json, os, sys
+from time import perf_counter
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src import connection_handler
+
+def synthetic_stream(tokens:int) -> list:
+    events = []
+    for i in range(tokens):
+        events.append(json.dumps({"model": "llama3:latest", "created_at": "2024-05-01T12:00:00.000000Z", "message": {"role": "assistant", "content": f" token{i}"}, "done": False}).encode("utf-8") + b"\n")
+    events.append(json.dumps({"model": "llama3:latest", "created_at": "2024-05-01T12:00:10.000000Z", "message": {"role": "assistant", "content": ""}, "done": True, "eval_count": tokens, "eval_duration": 10 ** 10}).encode("utf-8") + b"\n")
+    return events
+
+class ChunkedRaw(io.RawIOBase):
+    # Hands out one HTTP chunk per read like a chunked response does when tokens arrive one by one
+    def __init__(self, chunks:list):
+        self.chunks = iter(chunks)
+    def read(self, size=-1):
+        return next(self.chunks, b"")
+
+def response(raw) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = raw
+    return response
+
+def old_decode(response):
+    # What stream_post used to do, one json.loads and one callback per line
+    events = []
+    for line in response.iter_lines():
+        if line: events.append(json.loads(line.decode("utf-8")))
+    return len(events), len(events)
+
+def new_decode(response):
+    events = 0
+    callbacks = 0
+    for batch in connection_handler.iter_ndjson(response.iter_content(chunk_size=connection_handler.stream_chunk_size)):
+        events += len(batch)
+        callbacks += 1
+    return events, callbacks
+
+def http_chunked(events:list, tokens_per_read:int) -> list:
+    # What arrives from the socket when Ollama sends one HTTP chunk per token and tokens_per_read of them
+    # are waiting every time the stream is read
+    chunks = [f"{len(event):x}\r\n".encode("utf-8") + event + b"\r\n" for event in events] + [b"0\r\n\r\n"]
+    return [b"".join(chunks[i:i + tokens_per_read]) for i in range(0, len(chunks), tokens_per_read)]
+
+def stream_decode(reads:list) -> tuple:
+    # connection_handler.iter_body and split_ndjson like stream() uses them, one batch callback per yield
+    async def feed(reader):
+        for data in reads:
+            reader.feed_data(data)
+            # Lets the decoder take what was fed before the next read arrives
+            for _ in range(4): await asyncio.sleep(0)
+        reader.feed_eof()
+    async def decode():
+        reader = asyncio.StreamReader(limit=connection_handler.stream_chunk_size)
+        feeder = asyncio.get_running_loop().create_task(feed(reader))
+        events = 0
+        callbacks = 0
+        pending = []
+        async for chunk in connection_handler.iter_body(reader, {"transfer-encoding": "chunked"}, 10):
+            batch = connection_handler.split_ndjson(pending, chunk)
+            if batch:
+                events += len(batch)
+                callbacks += 1
+        await feeder
+        return events, callbacks
+    return asyncio.run(decode())
+
+def measure(function, make_raw, runs:int) -> tuple:
+    best = None
+    for _ in range(runs):
+        raw = make_raw()
+        start = perf_counter()
+        events, callbacks = function(response(raw))
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, events, callbacks
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=10000)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    events = synthetic_stream(args.tokens)
+    data = b"".join(events)
+    scenarios = {
+        "buffered (whole stream available)": lambda: io.BytesIO(data),
+        "chunked (one event per chunk)": lambda: ChunkedRaw(events)
+    }
+    print(f"{args.tokens} tokens, {len(data) / 1024:.0f} KiB, json decoder: {connection_handler.json_loads.__module__}")
+    for name, make_raw in scenarios.items():
+        old_time, old_events, _ = measure(old_decode, make_raw, args.runs)
+        new_time, new_events, callbacks = measure(new_decode, make_raw, args.runs)
+        assert old_events == new_events, "decoders disagree"
+        print(f"{name}: old {old_time * 1000:.1f} ms ({old_events} callbacks) | new {new_time * 1000:.1f} ms ({callbacks} callbacks) | {old_time / new_time:.1f}x")
+    for tokens_per_read in (1, 8, 64):
+        events_read, callbacks = stream_decode(http_chunked(events, tokens_per_read))
+        assert events_read == len(events), "iter_body lost events"
+        print(f"HTTP chunked, {tokens_per_read} tokens per read: {callbacks} callbacks for {events_read} events")
+
+if __name__ == "__main__":
+    main()
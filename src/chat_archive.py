@@ -0,0 +1,199 @@
+# chat_archive.py
+# Import and export of chats, this runs on a worker thread so it reports through callbacks
+import json, os, zipfile, hashlib, base64, codecs
+from . import chat_store
+
+archive_version = 1
+chunk_size = 1024 * 1024
+
+def write_chat_json(f, chat_name:str, messages:list, progress:callable=None):
+    # Messages are written one by one instead of serializing the whole chat first
+    f.write('{' + json.dumps(chat_name) + ': {"messages": [')
+    for i, message in enumerate(messages):
+        if i > 0: f.write(', ')
+        f.write(json.dumps(message))
+        if progress and i % 50 == 0: progress(i / len(messages))
+    f.write(']}}')
+
+def export_chat(path:str, chat_name:str, messages:list, progress:callable):
+    with open(path, "w") as f:
+        write_chat_json(f, chat_name, messages, progress)
+    progress(1)
+
+def export_archive(path:str, chats:dict, progress:callable):
+    written_images = set()
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("manifest.json", json.dumps({"version": archive_version, "chats": chats["chats"]}))
+        for i, (chat_id, chat) in enumerate(chats["chats"].items()):
+            messages = []
+            # Every branch is exported
+            for message in chat_store.get_tree(chat_id):
+                if "images" in message:
+                    # Images are stored once and referenced by their hash
+                    image_refs = []
+                    for image_base64 in message["images"]:
+                        image_hash = hashlib.sha256(image_base64.encode("utf-8")).hexdigest()
+                        if image_hash not in written_images:
+                            archive.writestr(f"images/{image_hash}", base64.b64decode(image_base64))
+                            written_images.add(image_hash)
+                        image_refs.append(f"sha256:{image_hash}")
+                    message = {**message, "images": image_refs}
+                messages.append(message)
+            with archive.open(f"chats/{chat_id}.json", "w") as f:
+                for data in json.JSONEncoder().iterencode({**chat, "messages": messages, "head": chat_store.heads.get(chat_id)}):
+                    f.write(data.encode("utf-8"))
+            progress((i + 1) / len(chats["chats"]))
+
+class JSONReader:
+    # Just enough of an incremental JSON reader for exported chats, values are decoded one at a time from a
+    # buffer that only holds what hasn't been decoded yet, so the file is never in memory as a whole
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, progress:callable):
+        self.f = f
+        self.progress = progress
+        self.total = max(1, os.fstat(f.fileno()).st_size)
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+
+    def fill(self) -> bool:
+        chunk = self.f.read(chunk_size)
+        self.text = self.text[self.pos:] + self.utf8.decode(chunk, final=not chunk)
+        self.pos = 0
+        self.progress(self.f.tell() / self.total)
+        return len(chunk) > 0
+
+    def peek(self) -> str:
+        # Next character that isn't whitespace
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in " \t\r\n": self.pos += 1
+            if self.pos < len(self.text): return self.text[self.pos]
+            if not self.fill(): raise ValueError("Unexpected end of file")
+
+    def expect(self, char:str):
+        if self.peek() != char: raise ValueError(f"Expected '{char}' at '{self.text[self.pos:self.pos + 20]}'")
+        self.pos += 1
+
+    def skip(self, char:str):
+        if self.peek() == char: self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try: value, end = self.decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                # Not all of it was read yet
+                if self.fill(): continue
+                raise
+            # A number at the end of the buffer could continue in the next chunk
+            if end == len(self.text) and self.fill(): continue
+            self.pos = end
+            return value
+
+def read_json(path:str, progress:callable):
+    # Every key is a chat, older versions only exported one. Chats are yielded as they are read and their
+    # messages are decoded one by one
+    with open(path, "rb") as f:
+        reader = JSONReader(f, progress)
+        reader.expect("{")
+        while reader.peek() != "}":
+            chat = {"id": None, "name": reader.value(), "messages": [], "head": None}
+            reader.expect(":")
+            reader.expect("{")
+            while reader.peek() != "}":
+                key = reader.value()
+                reader.expect(":")
+                if key == "messages":
+                    reader.expect("[")
+                    while reader.peek() != "]":
+                        chat["messages"].append(reader.value())
+                        reader.skip(",")
+                    reader.expect("]")
+                else: reader.value()
+                reader.skip(",")
+            reader.expect("}")
+            reader.skip(",")
+            yield chat
+
+def read_archive(path:str, progress:callable):
+    with zipfile.ZipFile(path, "r") as archive:
+        manifest = json.loads(archive.read("manifest.json"))
+        images = {}
+        for i, chat_id in enumerate(manifest["chats"]):
+            with archive.open(f"chats/{chat_id}.json") as f:
+                chat = json.load(f)
+            for message in chat["messages"]:
+                if "images" in message:
+                    for j, image_ref in enumerate(message["images"]):
+                        image_hash = image_ref.split(":", 1)[1]
+                        if image_hash not in images: images[image_hash] = base64.b64encode(archive.read(f"images/{image_hash}")).decode("utf-8")
+                        message["images"][j] = images[image_hash]
+            progress((i + 1) / len(manifest["chats"]))
+            yield {"id": chat_id, "name": chat["name"], "messages": chat["messages"], "head": chat.get("head")}
+
+def merge_tree(local_messages:list, messages:list, match_content:bool) -> tuple:
+    # Returns the imported messages that aren't in the local tree with their parents pointing to local
+    # messages, and the local id of every imported message. Older exports have no message ids, with
+    # match_content their messages are matched by what was said under the same parent instead
+    local_ids = {message["id"] for message in local_messages}
+    replies = {}
+    for message in local_messages: replies.setdefault(message["parent"], []).append(message)
+    ids = {}
+    added = []
+    for message in messages:
+        parent = ids.get(message["parent"], message["parent"])
+        if message["id"] in local_ids:
+            ids[message["id"]] = message["id"]
+            continue
+        if match_content:
+            match = next((reply for reply in replies.get(parent, []) if chat_store.same_messages([reply], [message])), None)
+            if match:
+                ids[message["id"]] = match["id"]
+                continue
+        message = {**message, "parent": parent}
+        added.append(message)
+        replies.setdefault(parent, []).append(message)
+        local_ids.add(message["id"])
+        ids[message["id"]] = message["id"]
+    return added, ids
+
+def merge(chats:dict, imported_chats) -> list:
+    # Returns (chat id, metadata) of every chat that was added or changed, chats itself isn't modified.
+    # A chat that already exists gets the imported messages it's missing added to its tree, every local
+    # message and branch is kept and the shown branch only moves forward if the import continues it
+    names = {chat["name"]: chat_id for chat_id, chat in chats["chats"].items()}
+    changes = []
+    for imported in imported_chats:
+        # Older exports can still have deleted messages as null
+        messages = [message for message in imported["messages"] if message]
+        match_content = not all("id" in message for message in messages)
+        chat_store.compact(messages)
+        head = imported["head"] or chat_store.default_head(messages)
+        chat_id = imported["id"]
+        if chat_id is None and imported["name"] in names: chat_id = names[imported["name"]]
+        if chat_id in chats["chats"]:
+            local_messages = chat_store.get_tree(chat_id)
+            local_head = chat_store.heads[chat_id]
+            added, ids = merge_tree(local_messages, messages, match_content)
+            if len(local_messages) == 0 or len(messages) == 0 or len(added) < len(messages):
+                merged = local_messages + added
+                if local_head is None or local_head in {message["id"] for message in chat_store.build_path(merged, ids.get(head))}: local_head = ids.get(head)
+                if len(added) > 0 or local_head != chat_store.heads[chat_id]:
+                    chat_store.set_messages(chat_id, merged, local_head)
+                    changes.append((chat_id, {**chats["chats"][chat_id], **chat_store.new_chat(chats["chats"][chat_id]["name"], chat_store.build_path(merged, local_head))}))
+                continue
+            # Nothing in common, it's another chat with the same name
+            chat_id = None
+        if chat_id is None or chat_id in chats["chats"]: chat_id = chat_store.new_id()
+        chat_name = chat_store.numbered_name(set(names), imported["name"])
+        names[chat_name] = chat_id
+        chat_store.set_messages(chat_id, messages, head)
+        changes.append((chat_id, chat_store.new_chat(chat_name, chat_store.build_path(messages, head))))
+    return changes
+
+def import_file(path:str, chats:dict, progress:callable) -> list:
+    if zipfile.is_zipfile(path): changes = merge(chats, read_archive(path, progress))
+    else: changes = merge(chats, read_json(path, progress))
+    progress(1)
+    return changes
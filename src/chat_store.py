@@ -0,0 +1,273 @@
+# chat_store.py
+# chats.json only keeps the metadata of every chat, the messages of each chat live in chats/{id}.json
+# and are loaded when needed, chats that haven't been used recently are dropped from memory.
+# Messages form a tree, each one points to its parent so branches share everything before the point
+# they split at, the head is the last message of the branch that is shown and sent to the model
+import json, os, uuid, threading
+from datetime import datetime
+from collections import OrderedDict
+from . import persistence
+
+config_dir = os.getenv("XDG_CONFIG_HOME")
+version = 3 # 2: messages have ids and no tombstones, 3: messages point to their parent
+memory_budget = 64 * 1024 * 1024 # Approximate size in bytes of the messages kept in memory
+checkpoint_interval = 5 # Seconds between saves of a reply that is still being generated, it's marked partial until it's done
+
+lock = threading.RLock()
+loaded_messages = OrderedDict() # chat id: messages of every branch in the order they were added, least recently used first
+heads = {} # chat id: id of the last message of the shown branch
+paths = {} # chat id: messages from the first one to the head, rebuilt when the branch changes
+loaded_sizes = {} # chat id: approximate size in bytes
+dirty = set() # chat ids with messages that haven't been written yet
+
+def path() -> str:
+    return os.path.join(config_dir, "chats.json")
+
+def chat_path(chat_id:str) -> str:
+    return os.path.join(config_dir, "chats", f"{chat_id}.json")
+
+def new_id() -> str:
+    return uuid.uuid4().hex
+
+def new_message_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+def now() -> str:
+    # Same format as message dates, it sorts as a string
+    return datetime.now().strftime("%Y/%m/%d %H:%M")
+
+def new_chat(chat_name:str, messages:list=None) -> dict:
+    messages = messages or []
+    last_activity = messages[-1]['date'] if len(messages) > 0 and 'date' in messages[-1] else now()
+    return {"name": chat_name, "last_activity": last_activity, "message_count": len(messages)}
+
+def compact(messages:list) -> bool:
+    # Deleted messages used to be left as None so list positions kept working as ids, they are removed
+    # and every message gets a stable id instead, messages without a parent come from a single branch
+    # chat and follow the previous one, returns True if anything changed
+    changed = False
+    if None in messages:
+        messages[:] = [message for message in messages if message]
+        changed = True
+    previous = None
+    for message in messages:
+        if "id" not in message:
+            message["id"] = new_message_id()
+            changed = True
+        if "parent" not in message:
+            message["parent"] = previous
+            changed = True
+        previous = message["id"]
+    return changed
+
+def default_head(messages:list) -> str:
+    return messages[-1]["id"] if len(messages) > 0 else None
+
+def find_message(messages:list, message_id:str) -> int:
+    for i, message in enumerate(messages):
+        if message["id"] == message_id: return i
+    return -1
+
+def build_path(messages:list, head:str) -> list:
+    by_id = {message["id"]: message for message in messages}
+    path = []
+    message = by_id.get(head)
+    while message:
+        path.append(message)
+        message = by_id.get(message["parent"])
+    path.reverse()
+    return path
+
+def children(messages:list) -> dict:
+    # parent id: ids of its children, oldest first
+    result = {}
+    for message in messages: result.setdefault(message["parent"], []).append(message["id"])
+    return result
+
+def request_messages(messages:list) -> list:
+    # Only what Ollama uses, dates, models, ids and parents stay out of the request. The shared part of
+    # every branch is built from the same stored messages so it's sent the same way and the server can
+    # reuse what it evaluated for it
+    return [{key: message[key] for key in ("role", "content", "images") if key in message} for message in messages]
+
+def same_messages(messages:list, other:list) -> bool:
+    return request_messages(messages) == request_messages(other)
+
+def migrate(chats:dict) -> dict:
+    if not all("name" in chat for chat in chats["chats"].values()):
+        # Chats used to be keyed by their name
+        migrated = {"chats": {}, "selected_chat": None}
+        for chat_name, chat in chats["chats"].items():
+            chat_id = new_id()
+            migrated["chats"][chat_id] = {"name": chat_name, **chat}
+            if chats.get("selected_chat") == chat_name: migrated["selected_chat"] = chat_id
+        chats = migrated
+    if any("messages" in chat for chat in chats["chats"].values()):
+        # And they used to keep their messages inline
+        for chat_id, chat in chats["chats"].items():
+            if "messages" in chat:
+                messages = chat.pop("messages")
+                set_messages(chat_id, messages)
+                chat.update(new_chat(chat["name"], messages))
+        save(chats)
+    if chats.get("version", 1) < version:
+        # One pass over every chat file written by older versions
+        for chat_id, chat in chats["chats"].items():
+            message_count = compact_file(chat_id)
+            if message_count is not None: chat["message_count"] = message_count
+        chats["version"] = version
+        save(chats)
+    return chats
+
+def load() -> dict:
+    persistence.flush(path())
+    if not os.path.exists(path()): return None
+    with open(path(), "r") as f:
+        return migrate(json.load(f))
+
+def serialize_messages(messages:list, head:str) -> str:
+    # Called on the writer thread, the list is copied since the main thread might still be appending to it
+    return json.dumps({"messages": list(messages), "head": head})
+
+def read_messages(chat_id:str) -> tuple:
+    with open(chat_path(chat_id), "r") as f:
+        data = json.load(f)
+    return data["messages"], data.get("head")
+
+def compact_file(chat_id:str) -> int:
+    # Returns the new number of messages if the file had to be rewritten
+    with lock:
+        if chat_id in loaded_messages: return None
+        persistence.flush(chat_path(chat_id))
+        if not os.path.exists(chat_path(chat_id)): return None
+        messages, head = read_messages(chat_id)
+        if not compact(messages): return None
+        head = head or default_head(messages)
+        persistence.write_atomic(chat_path(chat_id), serialize_messages(messages, head))
+        return len(build_path(messages, head))
+
+def write_messages(chat_id:str):
+    persistence.cancel(chat_path(chat_id))
+    data = serialize_messages(loaded_messages[chat_id], heads.get(chat_id))
+    persistence.write_atomic(chat_path(chat_id), data)
+    loaded_sizes[chat_id] = len(data)
+    dirty.discard(chat_id)
+
+def save(chats:dict, chat_ids:list=()):
+    with lock:
+        for chat_id in set(chat_ids) | dirty:
+            if chat_id in loaded_messages and chat_id in chats["chats"]:
+                persistence.schedule(chat_path(chat_id), lambda messages=loaded_messages[chat_id], head=heads.get(chat_id): serialize_messages(messages, head))
+                dirty.discard(chat_id)
+        for chat_id in loaded_messages:
+            if chat_id in chats["chats"]: chats["chats"][chat_id]["message_count"] = len(loaded_path(chat_id))
+        index = {**chats, "chats": {chat_id: dict(chat) for chat_id, chat in chats["chats"].items()}}
+        persistence.schedule(path(), lambda: json.dumps(index, indent=4))
+
+def evict(keep:str):
+    while sum(loaded_sizes.values()) > memory_budget and len(loaded_messages) > 1:
+        chat_id = next(iter(loaded_messages))
+        if chat_id == keep: break
+        if chat_id in dirty: write_messages(chat_id)
+        del loaded_messages[chat_id]
+        del loaded_sizes[chat_id]
+        heads.pop(chat_id, None)
+        paths.pop(chat_id, None)
+
+def get_tree(chat_id:str) -> list:
+    # Every message of every branch
+    with lock:
+        if chat_id not in loaded_messages:
+            persistence.flush(chat_path(chat_id))
+            messages, head = [], None
+            if os.path.exists(chat_path(chat_id)):
+                messages, head = read_messages(chat_id)
+                loaded_sizes[chat_id] = os.path.getsize(chat_path(chat_id))
+            else:
+                loaded_sizes[chat_id] = 0
+            if compact(messages): dirty.add(chat_id)
+            loaded_messages[chat_id] = messages
+            heads[chat_id] = head or default_head(messages)
+        loaded_messages.move_to_end(chat_id)
+        evict(chat_id)
+        return loaded_messages[chat_id]
+
+def loaded_path(chat_id:str) -> list:
+    if chat_id not in paths: paths[chat_id] = build_path(loaded_messages[chat_id], heads[chat_id])
+    return paths[chat_id]
+
+def get_messages(chat_id:str) -> list:
+    # The shown branch, don't add or remove messages from the list, use add_message and remove_message
+    with lock:
+        get_tree(chat_id)
+        return loaded_path(chat_id)
+
+def set_messages(chat_id:str, messages:list, head:str=None):
+    with lock:
+        compact(messages)
+        loaded_messages[chat_id] = messages
+        loaded_messages.move_to_end(chat_id)
+        loaded_sizes[chat_id] = len(json.dumps(messages))
+        heads[chat_id] = head or default_head(messages)
+        paths.pop(chat_id, None)
+        dirty.add(chat_id)
+        evict(chat_id)
+
+def add_message(chat_id:str, message:dict) -> dict:
+    # The message goes after the head and becomes the new head
+    with lock:
+        messages = get_tree(chat_id)
+        message["parent"] = heads[chat_id]
+        messages.append(message)
+        heads[chat_id] = message["id"]
+        if chat_id in paths: paths[chat_id].append(message)
+        dirty.add(chat_id)
+        return message
+
+def set_head(chat_id:str, message_id:str):
+    # None starts a branch before the first message
+    with lock:
+        get_tree(chat_id)
+        heads[chat_id] = message_id
+        paths.pop(chat_id, None)
+        dirty.add(chat_id)
+
+def switch_branch(chat_id:str, message_id:str):
+    # Shows the branch that goes through the message, following its newest replies
+    with lock:
+        branches = children(get_tree(chat_id))
+        while branches.get(message_id): message_id = branches[message_id][-1]
+        set_head(chat_id, message_id)
+
+def remove_message(chat_id:str, message_id:str) -> bool:
+    # Replies to the message are moved to its parent so no branch is lost
+    with lock:
+        messages = get_tree(chat_id)
+        index = find_message(messages, message_id)
+        if index == -1: return False
+        message = messages.pop(index)
+        for other in messages:
+            if other["parent"] == message_id: other["parent"] = message["parent"]
+        if heads[chat_id] == message_id: heads[chat_id] = message["parent"]
+        paths.pop(chat_id, None)
+        dirty.add(chat_id)
+        return True
+
+def delete(chat_id:str):
+    with lock:
+        loaded_messages.pop(chat_id, None)
+        loaded_sizes.pop(chat_id, None)
+        heads.pop(chat_id, None)
+        paths.pop(chat_id, None)
+        dirty.discard(chat_id)
+        persistence.cancel(chat_path(chat_id))
+        if os.path.exists(chat_path(chat_id)): os.remove(chat_path(chat_id))
+
+def generate_numbered_name(chats:dict, chat_name:str) -> str:
+    return numbered_name(set(chat["name"] for chat in chats["chats"].values()), chat_name)
+
+def numbered_name(names:set, chat_name:str) -> str:
+    if chat_name not in names: return chat_name
+    i = 1
+    while f"{chat_name} {i}" in names: i += 1
+    return f"{chat_name} {i}"
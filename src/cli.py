@@ -0,0 +1,128 @@
+# cli.py
+# Headless batch mode, this module must not import gi so it can run on servers without a display
+import argparse, json, os, sys
+from time import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from . import connection_handler, local_instance, chat_store, persistence
+
+def read_prompts(input_path:str) -> list:
+    prompts = []
+    with (sys.stdin if input_path == '-' else open(input_path, "r")) as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line: continue
+            prompt = json.loads(line)
+            if isinstance(prompt, str): prompt = {"prompt": prompt}
+            if "id" not in prompt: prompt["id"] = i
+            prompts.append(prompt)
+    return prompts
+
+def get_server_url() -> str:
+    server_config = os.path.join(chat_store.config_dir, "server.json") if chat_store.config_dir else None
+    if server_config and os.path.exists(server_config):
+        with open(server_config, "r") as f:
+            data = json.load(f)
+            if data['run_remote']: return data['remote_url']
+            local_instance.port = data['local_port']
+    return f"http://127.0.0.1:{local_instance.port}"
+
+def run_prompt(prompt:dict, model:str, options:dict) -> dict:
+    messages = prompt["messages"] if "messages" in prompt else [{"role": "user", "content": prompt["prompt"]}]
+    if "images" in prompt: messages[-1]["images"] = prompt["images"]
+    data = {"model": model, "messages": messages, "options": {**options, **prompt.get("options", {})}}
+    result = {"id": prompt["id"], "model": model, "prompt": messages[-1]["content"], "response": ""}
+    timing = {"first_token": None, "done": {}}
+    chunks = []
+
+    def callback(data):
+        if timing["first_token"] is None: timing["first_token"] = time()
+        if data['done']: timing["done"] = data
+        else: chunks.append(data['message']['content'])
+
+    result["started"] = datetime.now().isoformat()
+    start = time()
+    response = connection_handler.stream_post(f"{connection_handler.url}/api/chat", data=json.dumps(data), callback=callback)
+    end = time()
+    result["response"] = ''.join(chunks)
+    result["status"] = response['status']
+    result["status_code"] = response['status_code']
+    result["timing"] = {
+        "total": round(end - start, 4),
+        "first_token": round(timing["first_token"] - start, 4) if timing["first_token"] else None,
+        "load_duration": timing["done"].get("load_duration", 0) / 1e9,
+        "prompt_eval_count": timing["done"].get("prompt_eval_count", 0),
+        "eval_count": timing["done"].get("eval_count", 0),
+        "eval_duration": timing["done"].get("eval_duration", 0) / 1e9
+    }
+    if result["timing"]["eval_duration"] > 0:
+        result["timing"]["tokens_per_second"] = round(result["timing"]["eval_count"] / result["timing"]["eval_duration"], 2)
+    return result
+
+def save_chats(results:list, chat_name:str):
+    chats = chat_store.load() or {"chats": {}, "selected_chat": None}
+    for model in sorted(set(result["model"] for result in results)):
+        name = chat_store.generate_numbered_name(chats, f"{chat_name} ({model})")
+        messages = []
+        for result in sorted((result for result in results if result["model"] == model), key=lambda result: str(result["id"])):
+            date = datetime.fromisoformat(result["started"]).strftime("%Y/%m/%d %H:%M")
+            messages.append({"role": "user", "model": "User", "date": date, "content": result["prompt"]})
+            messages.append({"role": "assistant", "model": model, "date": date, "content": result["response"]})
+        chat_id = chat_store.new_id()
+        chats["chats"][chat_id] = chat_store.new_chat(name, messages)
+        chat_store.set_messages(chat_id, messages)
+    if chats["selected_chat"] is None: chats["selected_chat"] = list(chats["chats"].keys())[0]
+    chat_store.save(chats)
+    persistence.flush()
+
+def main(argv:list) -> int:
+    parser = argparse.ArgumentParser(prog="alpaca", description="Run a JSONL prompt set against one or more models without opening a window")
+    parser.add_argument("--batch", metavar="PROMPTS", required=True, help="JSONL file with one prompt per line ('-' for stdin)")
+    parser.add_argument("--model", "-m", action="append", default=[], help="Model to run every prompt against, can be used multiple times")
+    parser.add_argument("--output", "-o", default="-", help="JSONL file where results are streamed to (default: stdout)")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="Maximum number of concurrent requests (default: 1)")
+    parser.add_argument("--url", help="URL of the Ollama instance, defaults to the one configured in Alpaca")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-chat", metavar="NAME", help="Also store the results as chats in Alpaca")
+    args = parser.parse_args(argv)
+
+    prompts = read_prompts(args.batch)
+    jobs = [(prompt, model) for prompt in prompts for model in ([prompt["model"]] if "model" in prompt else args.model)]
+    if len(jobs) == 0:
+        parser.error("no jobs to run, use --model or set 'model' on every prompt")
+
+    started_instance = False
+    connection_handler.url = args.url if args.url else get_server_url()
+    if connection_handler.simple_get(connection_handler.url)['status'] != 'ok':
+        if args.url or connection_handler.url != f"http://127.0.0.1:{local_instance.port}":
+            print(f"Could not connect to {connection_handler.url}", file=sys.stderr)
+            return 1
+        # Started and waited for by the first request like in the window
+        connection_handler.request_hook = local_instance.in_use
+        try: connection_handler.run(local_instance.ensure_running())
+        except Exception as e:
+            print(f"Could not start Alpaca's Ollama instance: {e}", file=sys.stderr)
+            return 1
+        started_instance = True
+
+    options = {"temperature": args.temperature, "seed": args.seed}
+    results = []
+    failed = 0
+    output = sys.stdout if args.output == '-' else open(args.output, "w")
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+            futures = [executor.submit(run_prompt, prompt, model, options) for prompt, model in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                if result["status"] != "ok": failed += 1
+                results.append(result)
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+    finally:
+        if output is not sys.stdout: output.close()
+        if started_instance: connection_handler.run(local_instance.shutdown())
+
+    if args.save_chat: save_chats([result for result in results if result["status"] == "ok"], args.save_chat)
+    print(f"{len(results) - failed}/{len(results)} requests completed", file=sys.stderr)
+    return 0 if failed == 0 else 1
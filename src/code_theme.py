@@ -0,0 +1,36 @@
+# code_theme.py
+# Every code block follows the dark / light style from a single handler, the scheme is looked up once per
+# change and buffers are forgotten as soon as their view is destroyed.
+# GtkSource is loaded with the first code block instead of at startup
+import gi
+from gi.repository import Adw
+
+GtkSource = None
+buffers = set()
+scheme = None
+
+def source():
+    global GtkSource
+    if GtkSource is None:
+        gi.require_version('GtkSource', '5')
+        from gi.repository import GtkSource as module
+        module.init()
+        GtkSource = module
+    return GtkSource
+
+def current_scheme():
+    return GtkSource.StyleSchemeManager.get_default().get_scheme('Adwaita-dark' if Adw.StyleManager.get_default().get_dark() else 'Adwaita')
+
+def on_dark_changed(style_manager, pspec):
+    global scheme
+    scheme = current_scheme()
+    for buffer in buffers: buffer.set_style_scheme(scheme)
+
+def register(buffer, view):
+    global scheme
+    if scheme is None:
+        scheme = current_scheme()
+        Adw.StyleManager.get_default().connect("notify::dark", on_dark_changed)
+    buffer.set_style_scheme(scheme)
+    buffers.add(buffer)
+    view.connect("destroy", lambda view, buffer=buffer: buffers.discard(buffer))
@@ -0,0 +1,116 @@
+# diagnostics.py
+# Opt-in developer diagnostics: a watchdog thread notices when the main loop stops dispatching and samples
+# what the main thread is doing, plus counters that can be attached to bug reports.
+# It starts with ALPACA_DIAGNOSTICS=1 or when the diagnostics panel is opened
+import os, sys, threading, traceback, tracemalloc, platform
+from collections import deque
+from datetime import datetime
+from time import monotonic, sleep
+from gi.repository import GLib
+
+heartbeat_interval = 100 # Milliseconds between main loop heartbeats
+stall_threshold = 0.25 # Seconds without a heartbeat before the main thread is sampled
+max_stalls = 20
+
+enabled = False
+main_thread_id = None
+last_beat = None
+max_latency = 0
+stalls = deque(maxlen=max_stalls) # {"time", "duration", "stack"}
+counters = {} # name: function returning a number, registered by the window
+pending_idle = 0
+pending_lock = threading.Lock()
+original_idle_add = None
+
+def heartbeat():
+    # Runs on the main loop, latency is how late it ran
+    global last_beat, max_latency
+    now = monotonic()
+    latency = now - last_beat - heartbeat_interval / 1000
+    if latency > max_latency: max_latency = latency
+    if len(stalls) > 0 and stalls[-1]["duration"] is None:
+        stalls[-1]["duration"] = round(now - last_beat, 3)
+    last_beat = now
+    return True
+
+def watchdog():
+    sampled_beat = None
+    while True:
+        sleep(stall_threshold / 2)
+        beat = last_beat
+        if beat != sampled_beat and monotonic() - beat > stall_threshold:
+            # One sample per stall, taken while the main thread is still stuck
+            frame = sys._current_frames().get(main_thread_id)
+            stalls.append({
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "duration": None,
+                "stack": ''.join(traceback.format_stack(frame)) if frame else ""
+            })
+            sampled_beat = beat
+
+def counting_idle_add(function, *args, **kwargs):
+    global pending_idle
+    with pending_lock: pending_idle += 1
+    def run(*args):
+        global pending_idle
+        result = False
+        try: result = function(*args)
+        finally:
+            if not result:
+                with pending_lock: pending_idle -= 1
+        return result
+    return original_idle_add(run, *args, **kwargs)
+
+def enable():
+    # Must be called from the main thread
+    global enabled, main_thread_id, last_beat, original_idle_add
+    if enabled: return
+    enabled = True
+    main_thread_id = threading.get_ident()
+    last_beat = monotonic()
+    tracemalloc.start()
+    original_idle_add = GLib.idle_add
+    GLib.idle_add = counting_idle_add
+    GLib.timeout_add(heartbeat_interval, heartbeat)
+    threading.Thread(target=watchdog, name="diagnostics", daemon=True).start()
+
+def resident_memory() -> int:
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def top_allocations(limit:int=10) -> list:
+    if not tracemalloc.is_tracing(): return []
+    return [{"location": str(stat.traceback), "size": stat.size, "count": stat.count} for stat in tracemalloc.take_snapshot().statistics("lineno")[:limit]]
+
+def report() -> dict:
+    data = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "max_main_loop_latency": round(max_latency, 3),
+        "pending_idle_callbacks": pending_idle,
+        "resident_memory": resident_memory(),
+        "stalls": list(stalls),
+        "top_allocations": top_allocations()
+    }
+    for name, function in counters.items():
+        try: data[name] = function()
+        except Exception as e: data[name] = str(e)
+    return data
+
+def format_report(data:dict) -> str:
+    lines = []
+    for key, value in data.items():
+        if key in ("stalls", "top_allocations"): continue
+        if key == "resident_memory": value = GLib.format_size(value)
+        lines.append(f"{key}: {value}")
+    lines.append("")
+    lines.append(f"top allocations:")
+    for allocation in data["top_allocations"]:
+        lines.append(f"  {GLib.format_size(allocation['size'])} in {allocation['count']} blocks at {allocation['location']}")
+    lines.append("")
+    lines.append(f"stalls ({len(data['stalls'])}):")
+    for stall in reversed(data["stalls"]):
+        lines.append(f"  {stall['time']}, {stall['duration'] if stall['duration'] is not None else 'ongoing'}s")
+        lines.extend(f"    {line}" for line in stall["stack"].rstrip().split("\n"))
+    return "\n".join(lines)
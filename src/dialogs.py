@@ -1,7 +1,7 @@
 # dialogs.py
 
-from gi.repository import Adw, Gtk, Gdk, GLib, GtkSource, Gio, GdkPixbuf
-from .available_models import available_models
+from gi.repository import Adw, Gtk, Gdk, GLib, Gio
+from . import chat_store
 
 # CLEAR CHAT | WORKS
 
@@ -29,14 +29,14 @@ def clear_chat(self):
 
 # DELETE CHAT | WORKS
 
-def delete_chat_response(self, dialog, task, chat_name):
+def delete_chat_response(self, dialog, task, chat_id):
     if dialog.choose_finish(task) == "delete":
-        self.delete_chat(chat_name)
+        self.delete_chat(chat_id)
 
-def delete_chat(self, chat_name):
+def delete_chat(self, chat_id):
     dialog = Adw.AlertDialog(
         heading=_("Delete Chat"),
-        body=_("Are you sure you want to delete '{}'?").format(chat_name),
+        body=_("Are you sure you want to delete '{}'?").format(self.chats["chats"][chat_id]["name"]),
         close_response="cancel"
     )
     dialog.add_response("cancel", _("Cancel"))
@@ -45,20 +45,20 @@ def delete_chat(self, chat_name):
     dialog.choose(
         parent = self,
         cancellable = None,
-        callback = lambda dialog, task, chat_name=chat_name: delete_chat_response(self, dialog, task, chat_name)
+        callback = lambda dialog, task, chat_id=chat_id: delete_chat_response(self, dialog, task, chat_id)
     )
 
 # RENAME CHAT | WORKS
 
-def rename_chat_response(self, dialog, task, old_chat_name, entry, label_element):
+def rename_chat_response(self, dialog, task, chat_id, entry):
     if not entry: return
     new_chat_name = entry.get_text()
-    if old_chat_name == new_chat_name: return
+    if self.chats["chats"][chat_id]["name"] == new_chat_name: return
     if new_chat_name and (task is None or dialog.choose_finish(task) == "rename"):
-        self.rename_chat(old_chat_name, new_chat_name, label_element)
+        self.rename_chat(chat_id, new_chat_name)
 
-def rename_chat(self, label_element):
-    chat_name = label_element.get_parent().get_name()
+def rename_chat(self, chat_id):
+    chat_name = self.chats["chats"][chat_id]["name"]
     entry = Gtk.Entry()
     dialog = Adw.AlertDialog(
         heading=_("Rename Chat"),
@@ -66,14 +66,14 @@ def rename_chat(self, label_element):
         extra_child=entry,
         close_response="cancel"
     )
-    entry.connect("activate", lambda dialog, old_chat_name=chat_name, entry=entry, label_element=label_element: rename_chat_response(self, dialog, None, old_chat_name, entry, label_element))
+    entry.connect("activate", lambda dialog, chat_id=chat_id, entry=entry: rename_chat_response(self, dialog, None, chat_id, entry))
     dialog.add_response("cancel", _("Cancel"))
     dialog.add_response("rename", _("Rename"))
     dialog.set_response_appearance("rename", Adw.ResponseAppearance.SUGGESTED)
     dialog.choose(
         parent = self,
         cancellable = None,
-        callback = lambda dialog, task, old_chat_name=chat_name, entry=entry, label_element=label_element: rename_chat_response(self, dialog, task, old_chat_name, entry, label_element)
+        callback = lambda dialog, task, chat_id=chat_id, entry=entry: rename_chat_response(self, dialog, task, chat_id, entry)
     )
 
 # NEW CHAT | WORKS | UNUSED REASON: The 'Add Chat' button now creates a chat without a name AKA "New Chat"
@@ -154,6 +154,7 @@ def pull_model_response(self, dialog, task, model_name, tag_drop_down):
 
 def pull_model(self, model_name):
     tag_list = Gtk.StringList()
+    from .available_models import available_models
     for tag in available_models[model_name]['tags']:
         tag_list.append(f"{tag[0]} | {tag[1]}")
     tag_drop_down = Gtk.DropDown(
@@ -177,11 +178,11 @@ def pull_model(self, model_name):
 
 # REMOVE IMAGE | WORKS
 
-def remove_image_response(self, dialog, task):
+def remove_image_response(self, dialog, task, image):
     if dialog.choose_finish(task) == 'remove':
-        self.remove_image()
+        self.remove_image(image)
 
-def remove_image(self):
+def remove_image(self, image):
     dialog = Adw.AlertDialog(
         heading=_("Remove Image"),
         body=_("Are you sure you want to remove image?"),
@@ -193,7 +194,7 @@ def remove_image(self):
     dialog.choose(
         parent = self,
         cancellable = None,
-        callback = lambda dialog, task: remove_image_response(self, dialog, task)
+        callback = lambda dialog, task, image=image: remove_image_response(self, dialog, task, image)
     )
 
 # RECONNECT REMOTE |
@@ -227,3 +228,75 @@ def reconnect_remote(self, current_url):
         cancellable = None,
         callback = lambda dialog, task, entry=entry: reconnect_remote_response(self, dialog, task, entry)
     )
+
+# COMPARE MODELS |
+
+def compare_models_response(self, dialog, task, check_buttons):
+    if dialog.choose_finish(task) == "compare":
+        models = [model_name for model_name, check_button in check_buttons.items() if check_button.get_active()]
+        if len(models) > 0: self.compare_models(models)
+
+def compare_models(self):
+    list_box = Gtk.ListBox(
+        selection_mode = Gtk.SelectionMode.NONE,
+        css_classes = ["boxed-list"]
+    )
+    check_buttons = {}
+    for i in range(self.model_string_list.get_n_items()):
+        model_name = self.model_string_list.get_string(i)
+        check_button = Gtk.CheckButton(valign = 3)
+        model_row = Adw.ActionRow(
+            title = model_name,
+            activatable_widget = check_button
+        )
+        model_row.add_prefix(check_button)
+        list_box.append(model_row)
+        check_buttons[model_name] = check_button
+    dialog = Adw.AlertDialog(
+        heading=_("Compare Models"),
+        body=_("Select the models that will answer the current prompt"),
+        extra_child=Gtk.ScrolledWindow(child=list_box, propagate_natural_height=True, max_content_height=300),
+        close_response="cancel"
+    )
+    dialog.add_response("cancel", _("Cancel"))
+    dialog.add_response("compare", _("Compare"))
+    dialog.set_response_appearance("compare", Adw.ResponseAppearance.SUGGESTED)
+    dialog.choose(
+        parent = self,
+        cancellable = None,
+        callback = lambda dialog, task, check_buttons=check_buttons: compare_models_response(self, dialog, task, check_buttons)
+    )
+
+# EDIT MESSAGE |
+
+def edit_message_response(self, dialog, task, message_id, buffer):
+    if dialog.choose_finish(task) != "edit": return
+    content = buffer.get_text(buffer.get_start_iter(), buffer.get_end_iter(), False)
+    if content: self.edit_message(message_id, content)
+
+def edit_message(self, message_id):
+    message_index = chat_store.find_message(self.get_messages(), message_id)
+    if message_index == -1 or self.message_task: return
+    text_view = Gtk.TextView(
+        wrap_mode=Gtk.WrapMode.WORD,
+        top_margin=6,
+        bottom_margin=6,
+        left_margin=6,
+        right_margin=6,
+        css_classes=["card"]
+    )
+    text_view.get_buffer().set_text(self.get_messages()[message_index]["content"], -1)
+    dialog = Adw.AlertDialog(
+        heading=_("Edit Message"),
+        body=_("The edited message and its reply start a new branch, the original one is kept"),
+        extra_child=Gtk.ScrolledWindow(child=text_view, min_content_height=120, max_content_height=400, propagate_natural_height=True),
+        close_response="cancel"
+    )
+    dialog.add_response("cancel", _("Cancel"))
+    dialog.add_response("edit", _("Send"))
+    dialog.set_response_appearance("edit", Adw.ResponseAppearance.SUGGESTED)
+    dialog.choose(
+        parent = self,
+        cancellable = None,
+        callback = lambda dialog, task, message_id=message_id, buffer=text_view.get_buffer(): edit_message_response(self, dialog, task, message_id, buffer)
+    )
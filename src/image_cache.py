@@ -0,0 +1,196 @@
+# image_cache.py
+# Decodes, downscales and encodes images on a worker pool, results are cached by content hash
+import base64, hashlib, os, multiprocessing, threading
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from . import persistence
+# PIL is imported by the functions that use it so it isn't loaded until an image is
+
+cache_dir = os.path.join(os.getenv("XDG_CACHE_HOME"), "images") if os.getenv("XDG_CACHE_HOME") else None
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image")
+process_pool = None
+process_pool_lock = threading.Lock()
+process_pool_users = 0 # encode() calls running, the pool is shut down when the last one ends
+max_cached = 64
+max_disk_size = 256 * 1024 * 1024 # The oldest files in cache_dir are removed past this
+payloads = OrderedDict() # "{file hash}-{size}": base64 payload sent to the model
+thumbnails = OrderedDict() # payload hash: PNG bytes shown in the chat
+
+thumbnail_size = 240
+default_input_size = 672
+min_input_size = 224
+max_payload_size = 8 * 1024 * 1024 # Sum of every base64 image sent in a single message
+model_input_sizes = {"llava": 672, "llava-llama3": 336, "bakllava": 336, "moondream": 378}
+
+def input_size(model_name:str) -> int:
+    return model_input_sizes.get(model_name.split(":")[0], default_input_size)
+
+def payload_hash(image_base64:str) -> str:
+    return hashlib.sha256(image_base64.encode("utf-8")).hexdigest()
+
+def remember(cache:OrderedDict, key:str, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_cached: cache.popitem(last=False)
+
+def read_disk(name:str) -> bytes:
+    if cache_dir and os.path.exists(os.path.join(cache_dir, name)):
+        try:
+            with open(os.path.join(cache_dir, name), "rb") as f:
+                data = f.read()
+            # Used files are the last to be pruned
+            os.utime(os.path.join(cache_dir, name))
+            return data
+        except OSError as e:
+            print(e)
+
+def prune_disk():
+    files = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.startswith("."):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for mtime, size, path in files)
+    for mtime, size, path in sorted(files):
+        if total <= max_disk_size: break
+        os.remove(path)
+        total -= size
+
+def write_disk(name:str, data:bytes):
+    # Atomic so a crash can't leave a truncated image behind that would be reused as a payload
+    if not cache_dir: return
+    try:
+        persistence.write_atomic(os.path.join(cache_dir, name), data)
+        prune_disk()
+    except OSError as e:
+        print(e)
+
+def downscale(img, max_size:int):
+    from PIL import Image
+    width, height = img.size
+    if max(width, height) <= max_size: return img
+    if width > height:
+        new_width = max_size
+        new_height = max(1, int((max_size / width) * height))
+    else:
+        new_height = max_size
+        new_width = max(1, int((max_size / height) * width))
+    return img.resize((new_width, new_height), Image.LANCZOS)
+
+def to_png(img) -> bytes:
+    with BytesIO() as output:
+        img.save(output, format="PNG")
+        return output.getvalue()
+
+def store_thumbnail(key:str, thumbnail:bytes) -> bytes:
+    remember(thumbnails, key, thumbnail)
+    write_disk(f"{key}-thumbnail.png", thumbnail)
+    return thumbnail
+
+def make_thumbnail(img) -> bytes:
+    from PIL import Image
+    img.thumbnail((thumbnail_size, thumbnail_size), Image.LANCZOS)
+    return to_png(img)
+
+def encode_data(file_data:bytes, max_size:int) -> tuple:
+    # Runs on the process pool so it can't use the caches
+    from PIL import Image
+    with Image.open(BytesIO(file_data)) as img:
+        img = downscale(img.convert("RGBA") if img.mode not in ("RGB", "RGBA") else img, max_size)
+        return to_png(img), make_thumbnail(img.copy())
+
+def get_process_pool():
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1), mp_context=multiprocessing.get_context("spawn"))
+        return process_pool
+
+def use_process_pool():
+    global process_pool_users
+    with process_pool_lock: process_pool_users += 1
+
+def release_process_pool():
+    # The workers are whole interpreters with PIL loaded, they don't stay around between attachments
+    global process_pool, process_pool_users
+    with process_pool_lock:
+        process_pool_users -= 1
+        if process_pool_users == 0 and process_pool:
+            process_pool.shutdown(wait=False)
+            process_pool = None
+
+def encode_batch(files:list, max_size:int) -> list:
+    # Newly encoded images keep their payload and thumbnail so encode() can write the size it settles on
+    images = []
+    pending = {}
+    for path, file_data, file_hash in files:
+        key = f"{file_hash}-{max_size}"
+        image_base64 = payloads.get(key)
+        if image_base64 is None:
+            payload = read_disk(f"{key}.png")
+            if payload:
+                image_base64 = base64.b64encode(payload).decode("utf-8")
+            else:
+                try: pending[key] = get_process_pool().submit(encode_data, file_data, max_size)
+                except Exception as e:
+                    print(e)
+                    pending[key] = Future()
+                    pending[key].set_result(encode_data(file_data, max_size))
+        if image_base64: remember(payloads, key, image_base64)
+        images.append({"path": path, "key": key, "base64": image_base64, "payload": None, "thumbnail": None})
+    for image in images:
+        if image["base64"] is None:
+            image["payload"], image["thumbnail"] = pending[image["key"]].result()
+            image["base64"] = base64.b64encode(image["payload"]).decode("utf-8")
+            remember(payloads, image["key"], image["base64"])
+            remember(thumbnails, payload_hash(image["base64"]), image["thumbnail"])
+    return images
+
+def encode(paths:list, max_size:int) -> list:
+    files = []
+    for path in paths:
+        with open(path, "rb") as f:
+            file_data = f.read()
+        files.append((path, file_data, hashlib.sha256(file_data).hexdigest()))
+    use_process_pool()
+    try:
+        images = encode_batch(files, max_size)
+        while sum(len(image["base64"]) for image in images) > max_payload_size and max_size > min_input_size:
+            max_size = max(min_input_size, int(max_size * 0.75))
+            images = encode_batch(files, max_size)
+    finally: release_process_pool()
+    # Only the size that is sent goes to disk, not every size tried to fit max_payload_size
+    for image in images:
+        if image["payload"]:
+            write_disk(f"{image['key']}.png", image["payload"])
+            store_thumbnail(payload_hash(image["base64"]), image["thumbnail"])
+    return [{"path": image["path"], "base64": image["base64"]} for image in images]
+
+def decode_thumbnail(image_base64:str) -> bytes:
+    from PIL import Image
+    key = payload_hash(image_base64)
+    if key in thumbnails: return thumbnails[key]
+    thumbnail = read_disk(f"{key}-thumbnail.png")
+    if thumbnail:
+        remember(thumbnails, key, thumbnail)
+        return thumbnail
+    with Image.open(BytesIO(base64.b64decode(image_base64))) as img:
+        return store_thumbnail(key, make_thumbnail(img.copy()))
+
+def run(function:callable, callback:callable, *args):
+    def done(future):
+        try: result = future.result()
+        except Exception as e:
+            print(e)
+            result = None
+        callback(result)
+    executor.submit(function, *args).add_done_callback(done)
+
+def load(paths:list, max_size:int, callback:callable):
+    run(encode, callback, paths, max_size)
+
+def thumbnail(image_base64:str, callback:callable):
+    key = payload_hash(image_base64)
+    if key in thumbnails: callback(thumbnails[key])
+    else: run(decode_thumbnail, callback, image_base64)
@@ -1,23 +1,161 @@
 # local_instance.py
-import subprocess, os, threading
-from time import sleep
+# The instances are started when a request needs them and stopped after idle_timeout minutes without requests,
+# with more than one instance each gets its own port and share of the CPU cores and chats go to the least busy one
+import subprocess, os, asyncio, contextlib
+from time import monotonic
+from . import tracing
 
-instance = None
-port = 11435
+instances = [] # {"process", "port", "cpus", "threads", "active", "models"}
+port = 11435 # Port of the first instance, the rest use the ones after it
+pool_size = 1
 data_dir = os.getenv("XDG_DATA_HOME")
+idle_timeout = 0 # Minutes without requests before the instances are stopped, 0 keeps them running
+start_timeout = 30 # Seconds to wait for an instance to accept connections
 
-def start():
-    instance = subprocess.Popen(["/app/bin/ollama", "serve"], env={**os.environ, 'OLLAMA_HOST': f"127.0.0.1:{port}", "HOME": data_dir}, stderr=subprocess.PIPE, text=True)
+active_requests = 0
+last_request = monotonic()
+start_lock = None
+monitor = None
+
+def running() -> bool:
+    return len(instances) > 0 and all(instance["process"].poll() is None for instance in instances)
+
+def cpu_groups(count:int) -> list:
+    cpus = sorted(os.sched_getaffinity(0))
+    size = max(1, len(cpus) // count)
+    return [set(cpus[i * size:(i + 1) * size] if i < count - 1 else cpus[i * size:]) or set(cpus) for i in range(count)]
+
+def base_url(instance:dict) -> str:
+    return f"http://127.0.0.1:{instance['port']}"
+
+def log_path(index:int) -> str:
+    return os.path.join(data_dir, f"ollama-{index}.log")
+
+def launch_instance(index:int, cpus:set) -> dict:
+    # Affinity is per thread and inherited by new processes, so the instance starts with the calling thread
+    # pinned to its cores and every thread and runner it creates keeps them. preexec_fn isn't safe with
+    # other threads running and setting it on the pid afterwards misses the threads Ollama already started
+    previous_cpus = os.sched_getaffinity(0)
+    if cpus:
+        try: os.sched_setaffinity(0, cpus)
+        except OSError as e: print(e)
+    try:
+        # Ollama logs every request, a pipe nobody reads would fill up and block it
+        with open(log_path(index), "w") as log:
+            process = subprocess.Popen(
+                ["/app/bin/ollama", "serve"],
+                env={**os.environ, 'OLLAMA_HOST': f"127.0.0.1:{port + index}", "HOME": data_dir},
+                stdout=log,
+                stderr=subprocess.STDOUT
+            )
+    finally:
+        if cpus: os.sched_setaffinity(0, previous_cpus)
+    return {"process": process, "port": port + index, "cpus": cpus, "threads": len(cpus) if cpus else None, "active": 0, "models": set()}
+
+def launch():
+    groups = cpu_groups(pool_size) if pool_size > 1 else [None]
+    for i, cpus in enumerate(groups):
+        instances.append(launch_instance(i, cpus))
     print("Starting Alpaca's Ollama instance...")
-    sleep(1)
-    print("Started Alpaca's Ollama instance")
 
 def stop():
-    if instance: instance.kill()
+    global instances
+    stopped, instances = instances, []
+    for instance in stopped:
+        instance["process"].kill()
+        instance["process"].wait()
     print("Stopped Alpaca's Ollama instance")
 
-def reset():
+async def shutdown():
+    # stop() for the other threads, run on connection_handler's loop so it can't happen while
+    # ensure_running is between its steps
     stop()
-    sleep(1)
-    start()
 
+async def wait_for_instance(instance:dict, deadline:float) -> bool:
+    # False if the instance exited or didn't accept connections in time
+    while instance["process"].poll() is None:
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", instance["port"])
+            writer.close()
+            return True
+        except OSError:
+            if monotonic() > deadline: return False
+            await asyncio.sleep(0.1)
+    return False
+
+async def wait_until_ready():
+    deadline = monotonic() + start_timeout
+    for instance in instances:
+        if not await wait_for_instance(instance, deadline): raise ConnectionError("Alpaca's Ollama instance didn't start")
+    print("Started Alpaca's Ollama instance")
+
+async def idle_monitor():
+    while running():
+        await asyncio.sleep(30)
+        if idle_timeout > 0 and active_requests == 0 and monotonic() - last_request > idle_timeout * 60:
+            print("Alpaca's Ollama instance is idle")
+            stop()
+
+async def ensure_running():
+    # Requests that arrive while the instances are starting wait for the same start
+    global start_lock, monitor
+    if running(): return
+    if start_lock is None: start_lock = asyncio.Lock()
+    async with start_lock:
+        if running(): return
+        if instances: stop()
+        try:
+            with tracing.span("start local instance", "local instance", pool_size=pool_size):
+                launch()
+                await wait_until_ready()
+        except Exception as e:
+            stop()
+            raise ConnectionError(f"Could not start Alpaca's Ollama instance: {e}")
+        if monitor is None or monitor.done(): monitor = asyncio.get_running_loop().create_task(idle_monitor())
+
+def pick(model_name:str) -> dict:
+    # Least busy first, between equally busy instances the ones that already have the model loaded
+    return min(instances, key=lambda instance: (instance["active"], model_name not in instance["models"]))
+
+@contextlib.asynccontextmanager
+async def in_use(connection_url:str, data=None):
+    # Wrapped around every request by connection_handler while the local instances are used, yields
+    # the url and data the request should use
+    global active_requests, last_request
+    last_request = monotonic()
+    await ensure_running()
+    instance = instances[0]
+    if len(instances) > 1 and isinstance(data, dict) and "model" in data and connection_url.endswith("/api/chat"):
+        instance = pick(data["model"])
+        data = {**data, "options": {"num_thread": instance["threads"], **data.get("options", {})}}
+    connection_url = connection_url.replace(f"http://127.0.0.1:{port}", base_url(instance), 1)
+    if isinstance(data, dict) and "model" in data: instance["models"].add(data["model"])
+    instance["active"] += 1
+    active_requests += 1
+    try: yield connection_url, data
+    finally:
+        instance["active"] -= 1
+        active_requests -= 1
+        last_request = monotonic()
+
+def memory_usage() -> int:
+    # Resident memory in bytes of the instances and the runners they started
+    if not running(): return 0
+    children = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit(): continue
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+            children.setdefault(parent, []).append(int(pid))
+        except (OSError, IndexError, ValueError): continue
+    total = 0
+    pending = [instance["process"].pid for instance in instances]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open(f"/proc/{pid}/statm", "r") as f:
+                total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, IndexError, ValueError): continue
+    return total
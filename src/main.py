@@ -25,6 +25,7 @@ gi.require_version('Adw', '1')
 
 from gi.repository import Gtk, Gio, Adw
 from .window import AlpacaWindow
+from . import persistence
 
 class AlpacaApplication(Adw.Application):
     """The main application singleton class."""
@@ -42,6 +43,10 @@ class AlpacaApplication(Adw.Application):
             win = AlpacaWindow(application=self)
         win.present()
 
+    def do_shutdown(self):
+        persistence.flush()
+        Adw.Application.do_shutdown(self)
+
     def on_about_action(self, widget, _):
         about = Adw.AboutDialog(#transient_for=self.props.active_window,
             application_name='Alpaca',
@@ -0,0 +1,78 @@
+# message_parser.py
+# Splits a finished message into text and code parts with the inline markup already applied, the result
+# is cached in memory by the hash of the text so switching back to a chat doesn't parse it again.
+# There's no disk cache, parsing a message is cheaper than reading it back from a file
+import hashlib, re
+from collections import OrderedDict
+
+max_cached = 256
+parsed = OrderedDict() # text hash: parts
+
+code_block_pattern = re.compile(r'```(\w+)\n(.*?)\n```', re.DOTALL)
+bold_pattern = re.compile(r'\*\*(.*?)\*\*') #"**text**"
+code_pattern = re.compile(r'`(.*?)`') #"`text`"
+h1_pattern = re.compile(r'^#\s(.*)$') #"# text"
+h2_pattern = re.compile(r'^##\s(.*)$') #"## text"
+markup_pattern = re.compile(r'<(b|u|tt|span.*)>(.*?)<\/(b|u|tt|span)>') #heh butt span, I'm so funny
+
+def text_hash(text:str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def split_blocks(text:str) -> list:
+    parts = []
+    pos = 0
+    for match in code_block_pattern.finditer(text):
+        start, end = match.span()
+        if pos < start:
+            parts.append({"type": "normal", "text": text[pos:start].strip()})
+        parts.append({"type": "code", "text": match.group(2), "language": match.group(1)})
+        pos = end
+    # Any remaining normal text after the last code block
+    if pos < len(text) and text[pos:].strip():
+        parts.append({"type": "normal", "text": text[pos:].strip()})
+    return parts
+
+def apply_markup(text:str) -> list:
+    # Returns [is markup, text] spans
+    text = text.replace("\n* ", "\n• ")
+    text = code_pattern.sub(r'<tt>\1</tt>', text)
+    text = bold_pattern.sub(r'<b>\1</b>', text)
+    text = h1_pattern.sub(r'<span size="x-large">\1</span>', text)
+    text = h2_pattern.sub(r'<span size="large">\1</span>', text)
+    spans = []
+    position = 0
+    for match in markup_pattern.finditer(text):
+        start, end = match.span()
+        if position < start: spans.append([False, text[position:start]])
+        spans.append([True, match.group(0)])
+        position = end
+    if position < len(text): spans.append([False, text[position:]])
+    return spans
+
+def parse_text(text:str) -> list:
+    parts = split_blocks(text)
+    if len(parts) == 0: return parts
+    last_line = parts[-1]['text'].split("\n")[-1]
+    for part in parts:
+        if part['type'] == 'normal':
+            # The last line is the footer with the model and date
+            part['footer'] = None
+            if part['text'].split("\n")[-1] == last_line:
+                part['footer'] = "\n<small>" + part['text'].split('\n')[-1] + "</small>"
+                part['text'] = '\n'.join(part['text'].split("\n")[:-1])
+            part['spans'] = apply_markup(part.pop('text'))
+    return parts
+
+def remember(key:str, parts:list):
+    parsed[key] = parts
+    parsed.move_to_end(key)
+    while len(parsed) > max_cached: parsed.popitem(last=False)
+
+def parse(text:str) -> list:
+    key = text_hash(text)
+    if key in parsed:
+        parsed.move_to_end(key)
+        return parsed[key]
+    parts = parse_text(text)
+    remember(key, parts)
+    return parts
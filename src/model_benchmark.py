@@ -0,0 +1,93 @@
+# model_benchmark.py
+# Runs the same prompts against a model on the current backend and keeps the results per backend, so the
+# fastest model that answers within the latency target can be picked for the hardware it runs on
+import json, os, asyncio
+from time import monotonic
+from datetime import datetime
+from . import connection_handler, persistence, scheduler
+
+config_dir = os.getenv("XDG_CONFIG_HOME")
+prompts = [
+    "Explain what a hash table is in two sentences.",
+    "Write a Python function that returns the n-th Fibonacci number.",
+    "Summarize the plot of Romeo and Juliet in one paragraph."
+]
+max_tokens = 128 # Generated tokens per prompt, enough for stable numbers without taking minutes
+memory_interval = 1 # Seconds between checks of the memory used by the model
+latency_target = 0 # Seconds to the first token, 0 turns off picking the fastest model
+results = None # backend: {model name: result}, loaded when first needed
+
+def path() -> str:
+    return os.path.join(config_dir, "benchmarks.json")
+
+def load() -> dict:
+    global results
+    if results is None:
+        results = {}
+        try:
+            if os.path.exists(path()):
+                with open(path(), "r") as f:
+                    results = json.load(f)
+        except Exception as e:
+            print(e)
+    return results
+
+def backend() -> str:
+    return connection_handler.backend_name(connection_handler.url)
+
+def get(model_name:str) -> dict:
+    return load().get(backend(), {}).get(model_name)
+
+def save(model_name:str, result:dict):
+    load().setdefault(backend(), {})[model_name] = result
+    data = json.dumps(results, indent=4)
+    persistence.schedule(path(), lambda: data)
+
+def fastest(model_names:list, target:float) -> str:
+    # Fastest generation between the benchmarked models that start answering within target seconds
+    candidates = [(get(model_name)["tokens_per_second"], model_name) for model_name in model_names if get(model_name) and get(model_name)["first_token"] <= target]
+    return max(candidates)[1] if len(candidates) > 0 else None
+
+async def watch_memory(model_name:str, peak:dict):
+    while True:
+        response = await connection_handler.ps(scheduler.NORMAL)
+        if response['status'] == 'ok':
+            for model in json.loads(response['text'])['models']:
+                if model['name'] == model_name: peak['memory'] = max(peak['memory'], model.get('size', 0))
+        await asyncio.sleep(memory_interval)
+
+async def run(model_name:str, progress:callable=None) -> dict:
+    # Returns None if a request failed, progress gets the fraction that is done and is called on the network thread.
+    # The model is unloaded first so the first prompt measures the load, the rest measure a warm model
+    if (await connection_handler.unload(model_name))['status'] != 'ok': return None
+    totals = {"load_time": 0, "prompt_tokens": 0, "prompt_duration": 0, "tokens": 0, "duration": 0, "first_token": []}
+    peak = {"memory": 0}
+    watcher = asyncio.get_running_loop().create_task(watch_memory(model_name, peak))
+    try:
+        for i, prompt in enumerate(prompts):
+            start = monotonic()
+            first_token = []
+            final = []
+            def update(batch):
+                if len(first_token) == 0 and any(not data['done'] and data['message']['content'] for data in batch): first_token.append(monotonic() - start)
+                if batch[-1]['done']: final.append(batch[-1])
+            data = {"model": model_name, "messages": [{"role": "user", "content": prompt}], "options": {"temperature": 0, "seed": 1, "num_predict": max_tokens}}
+            response = await connection_handler.chat(data, update, scheduler.NORMAL)
+            if response['status'] != 'ok' or len(final) == 0: return None
+            if i == 0: totals["load_time"] = final[0].get("load_duration", 0) / 1e9
+            else: totals["first_token"].append(first_token[0] if len(first_token) > 0 else monotonic() - start)
+            totals["prompt_tokens"] += final[0].get("prompt_eval_count", 0)
+            totals["prompt_duration"] += final[0].get("prompt_eval_duration", 0)
+            totals["tokens"] += final[0].get("eval_count", 0)
+            totals["duration"] += final[0].get("eval_duration", 0)
+            if progress: progress((i + 1) / len(prompts))
+    finally:
+        watcher.cancel()
+    return {
+        "date": datetime.now().strftime("%Y/%m/%d %H:%M"),
+        "load_time": round(totals["load_time"], 2),
+        "prompt_tokens_per_second": round(totals["prompt_tokens"] / (totals["prompt_duration"] / 1e9), 1) if totals["prompt_duration"] else 0,
+        "tokens_per_second": round(totals["tokens"] / (totals["duration"] / 1e9), 1) if totals["duration"] else 0,
+        "first_token": round(sum(totals["first_token"]) / len(totals["first_token"]), 2) if totals["first_token"] else 0,
+        "memory": peak["memory"]
+    }
@@ -0,0 +1,37 @@
+# model_inventory.py
+# Remembers the last model list of the instance so it's only fetched again when it's stale and
+# the UI only updates the models that changed
+from time import monotonic
+
+ttl = 30 # Seconds a fetched list is trusted before Manage Models fetches it again
+ps_interval = 5 # Seconds between checks of the loaded models while Manage Models is open
+
+models = {} # name: model as returned by /api/tags, in the same order
+loaded = {} # name: model as returned by /api/ps
+fetched = None
+
+def fresh() -> bool:
+    return fetched is not None and monotonic() - fetched < ttl
+
+def invalidate():
+    global fetched
+    fetched = None
+
+def update(model_list:list) -> tuple:
+    # Returns the names of the models that were added, removed and changed (same name, different digest)
+    global models, fetched
+    new_models = {model["name"]: model for model in model_list}
+    added = [name for name in new_models if name not in models]
+    removed = [name for name in models if name not in new_models]
+    changed = [name for name in new_models if name in models and new_models[name].get("digest") != models[name].get("digest")]
+    models = new_models
+    fetched = monotonic()
+    return added, removed, changed
+
+def update_loaded(model_list:list) -> list:
+    # Returns the names of the models that were loaded or unloaded, or changed their memory usage
+    global loaded
+    new_loaded = {model["name"]: model for model in model_list}
+    changed = [name for name in set(loaded) | set(new_loaded) if loaded.get(name, {}).get("size") != new_loaded.get(name, {}).get("size")]
+    loaded = new_loaded
+    return changed
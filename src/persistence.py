@@ -0,0 +1,81 @@
+# persistence.py
+# Files are written atomically (temp file + rename) by a background thread, bursts of saves
+# to the same file are merged into a single write
+import os, tempfile, threading
+from time import monotonic
+
+delay = 0.5 # Seconds without new saves before writing
+max_delay = 2 # Seconds a save can wait while saves keep coming
+
+condition = threading.Condition()
+write_lock = threading.Lock() # Keeps writes in order between the writer thread and flush()
+pending = {} # path: function that returns the content to write
+first_change = None
+last_change = None
+thread = None
+
+def write_atomic(path:str, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path): os.remove(temp_path)
+        raise
+
+def write_jobs(jobs:dict):
+    for path, producer in jobs.items():
+        try: write_atomic(path, producer())
+        except Exception as e: print(f"Could not save {path}: {e}")
+
+def writer():
+    global first_change
+    while True:
+        with condition:
+            while len(pending) == 0: condition.wait()
+            while True:
+                # flush() can empty pending while this waits
+                if len(pending) == 0 or first_change is None: break
+                remaining = min(last_change + delay, first_change + max_delay) - monotonic()
+                if remaining <= 0: break
+                condition.wait(remaining)
+        with write_lock:
+            with condition:
+                jobs = dict(pending)
+                pending.clear()
+                first_change = None
+            write_jobs(jobs)
+
+def schedule(path:str, producer:callable):
+    global first_change, last_change, thread
+    with condition:
+        pending[path] = producer
+        last_change = monotonic()
+        if first_change is None: first_change = last_change
+        if thread is None:
+            thread = threading.Thread(target=writer, name="persistence", daemon=True)
+            thread.start()
+        condition.notify()
+
+def cancel(path:str):
+    global first_change
+    with condition:
+        pending.pop(path, None)
+        if len(pending) == 0: first_change = None
+
+def flush(path:str=None):
+    # Writes what's pending right away on the calling thread, used before reading a file back and on shutdown
+    global first_change
+    with write_lock:
+        with condition:
+            if path: jobs = {path: pending.pop(path)} if path in pending else {}
+            else:
+                jobs = dict(pending)
+                pending.clear()
+            if len(pending) == 0: first_change = None
+        write_jobs(jobs)
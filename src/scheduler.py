@@ -0,0 +1,87 @@
+# scheduler.py
+# Decides which request goes next to each backend, runs on connection_handler's loop. Lower classes go
+# first, requests that waited aging_interval seconds move up one class so background work isn't starved
+import asyncio, contextlib, itertools, math
+from time import monotonic
+
+INTERACTIVE = 0 # Chats the user is waiting for
+NORMAL = 1 # Quick requests the UI needs, model list, connection checks, deletes
+BACKGROUND = 2 # Pulls and polling
+class_names = {INTERACTIVE: "interactive", NORMAL: "normal", BACKGROUND: "background"}
+
+backend_limit = 4 # Requests running at the same time on a backend
+backend_limits = {} # backend: limit, for backends that can run more (or less) than backend_limit
+class_limits = {BACKGROUND: 2} # So there's always room for the other classes
+aging_interval = 10
+
+backends = {} # backend: {"running": {class: count}, "waiting": [waiter]}
+statistics = {priority: {"requests": 0, "waited": 0.0, "max_wait": 0.0} for priority in class_names}
+order = itertools.count()
+
+def get_backend(backend:str) -> dict:
+    if backend not in backends: backends[backend] = {"running": {priority: 0 for priority in class_names}, "waiting": []}
+    return backends[backend]
+
+def effective_priority(waiter:dict, now:float) -> float:
+    return waiter["priority"] - (now - waiter["queued"]) / aging_interval
+
+def aged_class(waiter:dict, now:float) -> int:
+    # The class a waiter counts as for class_limits once it moved up
+    return max(INTERACTIVE, math.ceil(effective_priority(waiter, now)))
+
+def can_run(backend:str, priority:int) -> bool:
+    running = backends[backend]["running"]
+    if sum(running.values()) >= backend_limits.get(backend, backend_limit): return False
+    return priority not in class_limits or running[priority] < class_limits[priority]
+
+def dispatch(backend:str):
+    now = monotonic()
+    state = backends[backend]
+    for waiter in sorted(state["waiting"], key=lambda waiter: (effective_priority(waiter, now), waiter["order"])):
+        if waiter["future"].done() or not can_run(backend, aged_class(waiter, now)): continue
+        state["waiting"].remove(waiter)
+        state["running"][waiter["priority"]] += 1
+        waited = now - waiter["queued"]
+        statistics[waiter["priority"]]["requests"] += 1
+        statistics[waiter["priority"]]["waited"] += waited
+        statistics[waiter["priority"]]["max_wait"] = max(statistics[waiter["priority"]]["max_wait"], waited)
+        waiter["future"].set_result(None)
+
+@contextlib.asynccontextmanager
+async def slot(backend:str, priority:int):
+    state = get_backend(backend)
+    waiter = {"priority": priority, "queued": monotonic(), "order": next(order), "future": asyncio.get_running_loop().create_future()}
+    state["waiting"].append(waiter)
+    dispatch(backend)
+    try:
+        while True:
+            # Checked again every aging_interval since waiting moves it up a class
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter["future"]), aging_interval)
+                break
+            except asyncio.TimeoutError: dispatch(backend)
+    except asyncio.CancelledError:
+        if waiter in state["waiting"]: state["waiting"].remove(waiter)
+        else:
+            # It got its turn while being cancelled
+            state["running"][priority] -= 1
+            dispatch(backend)
+        raise
+    try: yield
+    finally:
+        state["running"][priority] -= 1
+        dispatch(backend)
+
+def stats() -> dict:
+    # Queue depth, running requests and wait times of every class, call it from the loop or accept a slightly stale view
+    result = {}
+    for priority, name in class_names.items():
+        requests = statistics[priority]["requests"]
+        result[name] = {
+            "waiting": sum(len([waiter for waiter in state["waiting"] if waiter["priority"] == priority]) for state in list(backends.values())),
+            "running": sum(state["running"][priority] for state in list(backends.values())),
+            "requests": requests,
+            "average_wait": statistics[priority]["waited"] / requests if requests else 0,
+            "max_wait": statistics[priority]["max_wait"]
+        }
+    return result
@@ -0,0 +1,52 @@
+# tracing.py
+# Opt-in timeline of what happens during a chat turn, pulls and startup. Spans are kept in a ring buffer
+# and can be exported as a Chrome trace (chrome://tracing, ui.perfetto.dev).
+# It starts with ALPACA_TRACE=1 or from the diagnostics panel
+import os, json, threading, contextlib, functools
+from collections import deque
+from time import perf_counter
+
+max_events = 20000
+enabled = bool(os.getenv("ALPACA_TRACE"))
+events = deque(maxlen=max_events)
+thread_names = {} # thread id: name, exported as metadata
+origin = perf_counter()
+
+def now() -> int:
+    # Microseconds since the module was imported
+    return int((perf_counter() - origin) * 1e6)
+
+def add(event:dict):
+    thread = threading.current_thread()
+    if thread.ident not in thread_names: thread_names[thread.ident] = thread.name
+    events.append({**event, "pid": os.getpid(), "tid": thread.ident})
+
+def begin() -> int:
+    # For spans that start and end in different functions, pass the result to end()
+    return now() if enabled else None
+
+def end(name:str, start:int, category:str="alpaca", **args):
+    if start is None or not enabled: return
+    add({"name": name, "cat": category, "ph": "X", "ts": start, "dur": now() - start, "args": args})
+
+@contextlib.contextmanager
+def span(name:str, category:str="alpaca", **args):
+    start = begin()
+    try: yield
+    finally: end(name, start, category, **args)
+
+def traced(name:str, category:str="alpaca"):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, category): return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instant(name:str, category:str="alpaca", **args):
+    if enabled: add({"name": name, "cat": category, "ph": "i", "s": "t", "ts": now(), "args": args})
+
+def export(path:str):
+    metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}} for tid, name in list(thread_names.items())]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": metadata + list(events), "displayTimeUnit": "ms"}, f)
@@ -17,17 +17,19 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import gi
-gi.require_version('GtkSource', '5')
-gi.require_version('GdkPixbuf', '2.0')
-from gi.repository import Adw, Gtk, Gdk, GLib, GtkSource, Gio, GdkPixbuf
-import json, requests, threading, os, re, base64, sys, gettext, locale, webbrowser, subprocess
-from time import sleep
-from io import BytesIO
-from PIL import Image
+# GtkSource (code_theme.source()), PIL (image_cache) and the available models list are loaded when first needed
+from gi.repository import Adw, Gtk, Gdk, GLib, GObject, Gio
+import json, threading, asyncio, os, gettext, locale
+from time import time
 from datetime import datetime
-from .available_models import available_models
-from . import dialogs, local_instance, connection_handler
+from . import dialogs, local_instance, connection_handler, chat_store, image_cache, chat_archive, persistence, model_inventory, code_theme, message_parser, scheduler, diagnostics, tracing, model_benchmark
+
+class ChatItem(GObject.Object):
+    __gtype_name__ = 'AlpacaChatItem'
+
+    id = GObject.Property(type=str)
+    name = GObject.Property(type=str)
+    last_activity = GObject.Property(type=str)
 
 @Gtk.Template(resource_path='/com/jeffser/Alpaca/window.ui')
 class AlpacaWindow(Adw.ApplicationWindow):
@@ -48,15 +50,37 @@ class AlpacaWindow(Adw.ApplicationWindow):
     remote_url = ""
     run_remote = False
     model_tweaks = {"temperature": 0.7, "seed": 0, "keep_alive": 5}
+    compare_parallel = 1
     local_models = []
+    local_model_rows = {}
+    loaded_models_task = None
     pulling_models = {}
-    chats = {"chats": {_("New Chat"): {"messages": []}}, "selected_chat": "New Chat"}
-    attached_image = {"path": None, "base64": None}
+    benchmarking = {} # model name: fraction done
+    available_models_listed = False
+    message_task = None
+    bot_message_id = None
+    turn_trace = None
+    reply_chunks = [] # The reply being generated, joined into its message only when it's read or saved
+    last_checkpoint = 0
+    rendering = True # False while the window is hidden, replies only go to chat_store then
+    transcript_stale = False # Something wasn't drawn while hidden, the chat is rebuilt when the window is shown
+    chats = {"chats": {}, "selected_chat": None}
+    chat_list_model = None
+    chat_items = {}
+    chat_rows = {}
+    attached_images = []
 
     #Elements
     temperature_spin = Gtk.Template.Child()
     seed_spin = Gtk.Template.Child()
     keep_alive_spin = Gtk.Template.Child()
+    compare_parallel_spin = Gtk.Template.Child()
+    idle_timeout_spin = Gtk.Template.Child()
+    pool_size_spin = Gtk.Template.Child()
+    local_instance_status_row = Gtk.Template.Child()
+    latency_target_spin = Gtk.Template.Child()
+    fastest_model_row = Gtk.Template.Child()
+    use_fastest_model_button = Gtk.Template.Child()
     preferences_dialog = Gtk.Template.Child()
     shortcut_window : Gtk.ShortcutsWindow  = Gtk.Template.Child()
     bot_message : Gtk.TextBuffer = None
@@ -74,8 +98,10 @@ class AlpacaWindow(Adw.ApplicationWindow):
     send_button = Gtk.Template.Child()
     stop_button = Gtk.Template.Child()
     image_button = Gtk.Template.Child()
+    attachment_container = Gtk.Template.Child()
+    attachment_box = Gtk.Template.Child()
     file_filter_image = Gtk.Template.Child()
-    file_filter_json = Gtk.Template.Child()
+    file_filter_chats = Gtk.Template.Child()
     model_drop_down = Gtk.Template.Child()
     model_string_list = Gtk.Template.Child()
 
@@ -86,6 +112,7 @@ class AlpacaWindow(Adw.ApplicationWindow):
 
     chat_list_box = Gtk.Template.Child()
     add_chat_button = Gtk.Template.Child()
+    transfer_progress_bar = Gtk.Template.Child()
 
     loading_spinner = None
 
@@ -102,7 +129,10 @@ class AlpacaWindow(Adw.ApplicationWindow):
             _("Could not pull model"),
             _("Cannot open image"),
             _("Cannot delete chat because it's the only one left"),
-            _("There was an error with the local Ollama instance, so it has been reset")
+            _("There was an error with the local Ollama instance, so it has been reset"),
+            _("Could not export chats"),
+            _("Could not import chats"),
+            _("Could not benchmark model")
         ],
         "info": [
             _("Please select a model before chatting"),
@@ -110,17 +140,19 @@ class AlpacaWindow(Adw.ApplicationWindow):
             _("That tag is already being pulled"),
             _("That tag has been pulled already"),
             _("Code copied to the clipboard"),
-            _("Message copied to the clipboard")
+            _("Message copied to the clipboard"),
+            _("Please write a prompt before comparing models")
         ],
         "good": [
             _("Model deleted successfully"),
             _("Model pulled successfully"),
             _("Chat exported successfully"),
-            _("Chat imported successfully")
+            _("Chat imported successfully"),
+            _("Chats exported successfully"),
+            _("Model benchmarked successfully")
         ]
     }
 
-    style_manager = Adw.StyleManager()
 
     @Gtk.Template.Callback()
     def verify_if_image_can_be_used(self, pspec=None, user_data=None):
@@ -128,21 +160,25 @@ class AlpacaWindow(Adw.ApplicationWindow):
         selected = self.model_drop_down.get_selected_item().get_string().split(":")[0]
         if selected in ['llava', 'bakllava', 'moondream', 'llava-llama3']:
             self.image_button.set_sensitive(True)
-            self.image_button.set_tooltip_text(_("Upload image"))
+            self.image_button.set_tooltip_text(_("Attach images"))
             return True
         else:
             self.image_button.set_sensitive(False)
             self.image_button.set_tooltip_text(_("Only available on selected models"))
-            self.image_button.set_css_classes(["circular"])
-            self.attached_image = {"path": None, "base64": None}
+            if len(self.attached_images) > 0: self.remove_images()
             return False
 
     @Gtk.Template.Callback()
     def stop_message(self, button=None):
+        if self.message_task: self.message_task.cancel()
+        self.message_task = None
+        tracing.end("chat turn", self.turn_trace, "chat", status="stopped")
+        self.turn_trace = None
+        self.join_reply()
+        self.save_history()
         if self.loading_spinner: self.chat_container.remove(self.loading_spinner)
         if self.verify_if_image_can_be_used(): self.image_button.set_sensitive(True)
-        self.image_button.set_css_classes(["circular"])
-        self.attached_image = {"path": None, "base64": None}
+        self.remove_images()
         self.toggle_ui_sensitive(True)
         self.switch_send_stop_button()
         self.bot_message = None
@@ -156,39 +192,125 @@ class AlpacaWindow(Adw.ApplicationWindow):
         if current_model is None:
             self.show_toast("info", 0, self.main_overlay)
             return
+        self.turn_trace = tracing.begin()
         formated_datetime = datetime.now().strftime("%Y/%m/%d %H:%M")
-        self.chats["chats"][self.chats["selected_chat"]]["messages"].append({
+        message = chat_store.add_message(self.chats["selected_chat"], {
+            "id": chat_store.new_message_id(),
             "role": "user",
             "model": "User",
             "date": formated_datetime,
             "content": self.message_text_view.get_buffer().get_text(self.message_text_view.get_buffer().get_start_iter(), self.message_text_view.get_buffer().get_end_iter(), False)
         })
-        data = {
-            "model": current_model.get_string(),
-            "messages": self.chats["chats"][self.chats["selected_chat"]]["messages"],
-            "options": {"temperature": self.model_tweaks["temperature"], "seed": self.model_tweaks["seed"]},
-            "keep_alive": f"{self.model_tweaks['keep_alive']}m"
-        }
-        if self.verify_if_image_can_be_used() and self.attached_image["base64"] is not None:
-            data["messages"][-1]["images"] = [self.attached_image["base64"]]
-        self.switch_send_stop_button()
-        self.toggle_ui_sensitive(False)
-        self.image_button.set_sensitive(False)
+        if self.verify_if_image_can_be_used() and len(self.attached_images) > 0:
+            message["images"] = [image["base64"] for image in self.attached_images]
 
-        self.show_message(self.message_text_view.get_buffer().get_text(self.message_text_view.get_buffer().get_start_iter(), self.message_text_view.get_buffer().get_end_iter(), False), False, f"\n\n<small>{formated_datetime}</small>", self.attached_image["base64"], id=len(self.chats["chats"][self.chats["selected_chat"]]["messages"])-1)
+        self.show_message(message["content"], False, f"\n\n<small>{formated_datetime}</small>", message.get("images"), id=message["id"])
         self.message_text_view.get_buffer().set_text("", 0)
-        self.loading_spinner = Gtk.Spinner(spinning=True, margin_top=12, margin_bottom=12, hexpand=True)
-        self.chat_container.append(self.loading_spinner)
-        self.show_message("", True, id=len(self.chats["chats"][self.chats["selected_chat"]]["messages"]))
+        self.remove_images()
+        self.generate_reply(current_model.get_string(), formated_datetime)
+        tracing.end("send message", self.turn_trace, "ui")
 
-        thread = threading.Thread(target=self.run_message, args=(data['messages'], data['model']))
-        thread.start()
+    def generate_reply(self, model:str, formated_datetime:str, resume:dict=None):
+        # Answers the last message of the shown branch, or continues it if it's a partial reply
+        self.switch_send_stop_button()
+        self.toggle_ui_sensitive(False)
+        self.image_button.set_sensitive(False)
+        self.last_checkpoint = time()
+        if resume:
+            self.bot_message_id = resume['id']
+            self.reply_chunks = [resume['content']]
+            self.show_message(resume['content'], True, id=self.bot_message_id)
+        else:
+            self.loading_spinner = Gtk.Spinner(spinning=True, margin_top=12, margin_bottom=12, hexpand=True)
+            self.chat_container.append(self.loading_spinner)
+            self.bot_message_id = chat_store.new_message_id()
+            self.reply_chunks = []
+            self.show_message("", True, id=self.bot_message_id)
+        self.update_chat_activity(self.chats["selected_chat"], formated_datetime)
+
+        with tracing.span("context assembly", "chat", messages=len(self.get_messages())):
+            messages = chat_store.request_messages(self.get_messages())
+        self.run_message(messages, model)
+
+    def resume_message(self, message_element):
+        # Continues a reply that was cut off, the model carries on from the partial assistant message
+        if self.message_task: return
+        messages = self.get_messages()
+        if len(messages) == 0 or messages[-1]['id'] != message_element.get_name(): return
+        self.turn_trace = tracing.begin()
+        self.chat_container.remove(message_element)
+        self.generate_reply(messages[-1]['model'], datetime.now().strftime("%Y/%m/%d %H:%M"), messages[-1])
+
+    def join_reply(self, done:bool=False):
+        # Writes the chunks received so far into the reply's message
+        with chat_store.lock:
+            messages = self.get_messages()
+            if len(messages) == 0 or messages[-1]['id'] != self.bot_message_id: return
+            messages[-1]['content'] = ''.join(self.reply_chunks)
+            self.reply_chunks = [messages[-1]['content']]
+            if done: messages[-1].pop('partial', None)
+            else: messages[-1]['partial'] = True
+
+    def regenerate_message(self, message_element):
+        # The new reply goes next to the old one, in a new branch
+        if self.message_task: return
+        current_model = self.model_drop_down.get_selected_item()
+        if current_model is None:
+            self.show_toast("info", 0, self.main_overlay)
+            return
+        message_index = chat_store.find_message(self.get_messages(), message_element.get_name())
+        if message_index == -1: return
+        self.turn_trace = tracing.begin()
+        chat_store.set_head(self.chats["selected_chat"], self.get_messages()[message_index]["parent"])
+        self.load_history_into_chat()
+        self.generate_reply(current_model.get_string(), datetime.now().strftime("%Y/%m/%d %H:%M"))
+
+    def edit_message(self, message_id:str, content:str):
+        # The edited message goes next to the original one, in a new branch
+        if self.message_task: return
+        current_model = self.model_drop_down.get_selected_item()
+        if current_model is None:
+            self.show_toast("info", 0, self.main_overlay)
+            return
+        message_index = chat_store.find_message(self.get_messages(), message_id)
+        if message_index == -1: return
+        self.turn_trace = tracing.begin()
+        original = self.get_messages()[message_index]
+        formated_datetime = datetime.now().strftime("%Y/%m/%d %H:%M")
+        chat_store.set_head(self.chats["selected_chat"], original["parent"])
+        message = {
+            "id": chat_store.new_message_id(),
+            "role": "user",
+            "model": "User",
+            "date": formated_datetime,
+            "content": content
+        }
+        if "images" in original: message["images"] = original["images"]
+        chat_store.add_message(self.chats["selected_chat"], message)
+        self.load_history_into_chat()
+        self.generate_reply(current_model.get_string(), formated_datetime)
+
+    def switch_branch(self, message_id:str, offset:int):
+        # Shows the previous (-1) or next (1) branch at the message
+        if self.message_task: return
+        messages = chat_store.get_tree(self.chats["selected_chat"])
+        message = messages[chat_store.find_message(messages, message_id)]
+        siblings = chat_store.children(messages)[message["parent"]]
+        chat_store.switch_branch(self.chats["selected_chat"], siblings[(siblings.index(message_id) + offset) % len(siblings)])
+        self.load_history_into_chat()
+        self.save_history()
 
     @Gtk.Template.Callback()
     def manage_models_button_activate(self, button=None):
         self.update_list_local_models()
+        if not self.available_models_listed: self.update_list_available_models()
+        if self.loaded_models_task is None: self.loaded_models_task = self.run_async(self.poll_loaded_models())
         self.manage_models_dialog.present(self)
 
+    def manage_models_closed(self, dialog):
+        if self.loaded_models_task: self.loaded_models_task.cancel()
+        self.loaded_models_task = None
+
     @Gtk.Template.Callback()
     def welcome_carousel_page_changed(self, carousel, index):
         if index == 0: self.welcome_previous_button.set_sensitive(False)
@@ -205,25 +327,21 @@ class AlpacaWindow(Adw.ApplicationWindow):
         if button.get_label() == "Next": self.welcome_carousel.scroll_to(self.welcome_carousel.get_nth_page(self.welcome_carousel.get_position()+1), True)
         else:
             self.welcome_dialog.force_close()
-            if not self.verify_connection():
-                self.connection_error()
+            self.verify_connection(self.connection_checked)
 
     @Gtk.Template.Callback()
     def open_image(self, button):
-        if "destructive-action" in button.get_css_classes():
-            dialogs.remove_image(self)
-        else:
-            file_dialog = Gtk.FileDialog(default_filter=self.file_filter_image)
-            file_dialog.open(self, None, self.load_image)
+        file_dialog = Gtk.FileDialog(default_filter=self.file_filter_image)
+        file_dialog.open_multiple(self, None, self.load_image)
 
     @Gtk.Template.Callback()
     def chat_changed(self, listbox, row):
         if row and row.get_name() != self.chats["selected_chat"]:
             self.chats["selected_chat"] = row.get_name()
             self.load_history_into_chat()
-            if len(self.chats["chats"][self.chats["selected_chat"]]["messages"]) > 0:
+            if len(self.get_messages()) > 0:
                 for i in range(self.model_string_list.get_n_items()):
-                    if self.model_string_list.get_string(i) == self.chats["chats"][self.chats["selected_chat"]]["messages"][-1]["model"]:
+                    if self.model_string_list.get_string(i) == self.get_messages()[-1]["model"]:
                         self.model_drop_down.set_selected(i)
                         break
 
@@ -232,9 +350,12 @@ class AlpacaWindow(Adw.ApplicationWindow):
         self.remote_url = entry.get_text()
         if self.run_remote:
             connection_handler.url = self.remote_url
-            if self.verify_connection() == False:
-                entry.set_css_classes(["error"])
-                self.show_toast("error", 1, self.preferences_dialog)
+            self.verify_connection(lambda connected, entry=entry: self.remote_url_checked(entry, connected))
+
+    def remote_url_checked(self, entry, connected):
+        if not connected:
+            entry.set_css_classes(["error"])
+            self.show_toast("error", 1, self.preferences_dialog)
 
     @Gtk.Template.Callback()
     def pull_featured_model(self, button):
@@ -254,7 +375,8 @@ class AlpacaWindow(Adw.ApplicationWindow):
             print("Hiding app...")
         else:
             print("Closing app...")
-            local_instance.stop()
+            persistence.flush()
+            connection_handler.run(local_instance.shutdown())
 
     @Gtk.Template.Callback()
     def model_spin_changed(self, spin):
@@ -266,6 +388,38 @@ class AlpacaWindow(Adw.ApplicationWindow):
             print(self.model_tweaks)
             self.save_server_config()
 
+    @Gtk.Template.Callback()
+    def compare_parallel_changed(self, spin):
+        value = round(spin.get_value())
+        if self.compare_parallel != value:
+            self.compare_parallel = value
+            self.save_server_config()
+
+    @Gtk.Template.Callback()
+    def latency_target_changed(self, spin):
+        value = round(spin.get_value(), 1)
+        if model_benchmark.latency_target != value:
+            model_benchmark.latency_target = value
+            self.save_server_config()
+            self.update_fastest_model()
+
+    @Gtk.Template.Callback()
+    def idle_timeout_changed(self, spin):
+        value = round(spin.get_value())
+        if local_instance.idle_timeout != value:
+            local_instance.idle_timeout = value
+            self.save_server_config()
+
+    @Gtk.Template.Callback()
+    def pool_size_changed(self, spin):
+        value = round(spin.get_value())
+        if local_instance.pool_size != value:
+            local_instance.pool_size = value
+            scheduler.backend_limits[connection_handler.backend_name(f"http://127.0.0.1:{local_instance.port}")] = scheduler.backend_limit * value
+            self.save_server_config()
+            # Restarted with the new size by the next request, running chats aren't interrupted
+            if local_instance.active_requests == 0: connection_handler.submit(local_instance.shutdown())
+
     def show_toast(self, message_type:str, message_id:int, overlay):
         if message_type not in self.toast_messages or message_id > len(self.toast_messages[message_type] or message_id < 0):
             message_type = "error"
@@ -284,20 +438,19 @@ class AlpacaWindow(Adw.ApplicationWindow):
             self.get_application().send_notification(None, notification)
 
     def delete_message(self, message_element):
-        message_index = int(message_element.get_name())
-        if message_index < len(self.chats["chats"][self.chats["selected_chat"]]["messages"]):
-            self.chats["chats"][self.chats["selected_chat"]]["messages"][message_index] = None
+        if chat_store.remove_message(self.chats["selected_chat"], message_element.get_name()):
             self.chat_container.remove(message_element)
             self.save_history()
 
     def copy_message(self, message_element):
-        message_index = int(message_element.get_name())
-        print(message_index)
+        message_index = chat_store.find_message(self.get_messages(), message_element.get_name())
+        if message_index == -1: return
         clipboard = Gdk.Display().get_default().get_clipboard()
-        clipboard.set(self.chats["chats"][self.chats["selected_chat"]]["messages"][message_index]["content"])
+        clipboard.set(self.get_messages()[message_index]["content"])
         self.show_toast("info", 5, self.main_overlay)
 
-    def show_message(self, msg:str, bot:bool, footer:str=None, image_base64:str=None, id:int=-1):
+    def show_message(self, msg:str, bot:bool, footer:str=None, images:list=None, id:str=None, branch:tuple=None, resumable:bool=False):
+        # branch is (position, count) for messages that have alternatives
         message_text = Gtk.TextView(
             editable=False,
             focusable=True,
@@ -340,23 +493,25 @@ class AlpacaWindow(Adw.ApplicationWindow):
         )
         message_text.set_valign(Gtk.Align.CENTER)
 
-        if image_base64 is not None:
-            image_data = base64.b64decode(image_base64)
-            loader = GdkPixbuf.PixbufLoader.new()
-            loader.write(image_data)
-            loader.close()
-
-            pixbuf = loader.get_pixbuf()
-            texture = Gdk.Texture.new_for_pixbuf(pixbuf)
-
-            image = Gtk.Image.new_from_paintable(texture)
-            image.set_size_request(240, 240)
-            image.set_margin_top(10)
-            image.set_margin_start(10)
-            image.set_margin_end(10)
-            image.set_hexpand(False)
-            image.set_css_classes(["flat"])
-            message_box.append(image)
+        if images:
+            image_container = Gtk.FlowBox(
+                selection_mode=Gtk.SelectionMode.NONE,
+                homogeneous=True,
+                max_children_per_line=4,
+                margin_top=10,
+                margin_start=10,
+                margin_end=10
+            )
+            for image_base64 in images:
+                image = Gtk.Image(
+                    width_request=240,
+                    height_request=240,
+                    hexpand=False,
+                    css_classes=["flat"]
+                )
+                image_cache.thumbnail(image_base64, lambda thumbnail, image=image: GLib.idle_add(self.set_message_image, image, thumbnail))
+                image_container.append(image)
+            message_box.append(image_container)
 
         message_box.append(message_text)
         overlay = Gtk.Overlay(css_classes=["message"], name=id)
@@ -364,6 +519,25 @@ class AlpacaWindow(Adw.ApplicationWindow):
 
         delete_button.connect("clicked", lambda button, element=overlay: self.delete_message(element))
         copy_button.connect("clicked", lambda button, element=overlay: self.copy_message(element))
+        if branch:
+            previous_button = Gtk.Button(icon_name="go-previous-symbolic", tooltip_text=_("Previous Branch"), css_classes=["flat", "circular"])
+            next_button = Gtk.Button(icon_name="go-next-symbolic", tooltip_text=_("Next Branch"), css_classes=["flat", "circular"])
+            previous_button.connect("clicked", lambda button, element=overlay: self.switch_branch(element.get_name(), -1))
+            next_button.connect("clicked", lambda button, element=overlay: self.switch_branch(element.get_name(), 1))
+            button_container.append(previous_button)
+            button_container.append(Gtk.Label(label=f"{branch[0]}/{branch[1]}", css_classes=["dim-label", "caption"]))
+            button_container.append(next_button)
+        if resumable:
+            resume_button = Gtk.Button(icon_name="media-playback-start-symbolic", tooltip_text=_("Continue"), css_classes=["flat", "circular"])
+            resume_button.connect("clicked", lambda button, element=overlay: self.resume_message(element))
+            button_container.append(resume_button)
+        if bot:
+            branch_button = Gtk.Button(icon_name="view-refresh-symbolic", tooltip_text=_("Regenerate"), css_classes=["flat", "circular", "delete-message-button"])
+            branch_button.connect("clicked", lambda button, element=overlay: self.regenerate_message(element))
+        else:
+            branch_button = Gtk.Button(icon_name="document-edit-symbolic", tooltip_text=_("Edit"), css_classes=["flat", "circular", "delete-message-button"])
+            branch_button.connect("clicked", lambda button, element=overlay: dialogs.edit_message(self, element.get_name()))
+        button_container.append(branch_button)
         button_container.append(delete_button)
         button_container.append(copy_button)
         overlay.add_overlay(button_container)
@@ -374,79 +548,162 @@ class AlpacaWindow(Adw.ApplicationWindow):
             self.bot_message_view = message_text
             self.bot_message_box = message_box
 
-    def update_list_local_models(self):
-        self.local_models = []
-        response = connection_handler.simple_get(connection_handler.url + "/api/tags")
-        for i in range(self.model_string_list.get_n_items() -1, -1, -1):
-            self.model_string_list.remove(i)
-        if response['status'] == 'ok':
-            self.local_model_list_box.remove_all()
-            if len(json.loads(response['text'])['models']) == 0:
-                self.local_model_list_box.set_visible(False)
-            else:
-                self.local_model_list_box.set_visible(True)
-            for model in json.loads(response['text'])['models']:
-                model_row = Adw.ActionRow(
-                    title = model["name"].split(":")[0],
-                    subtitle = model["name"].split(":")[1]
-                )
-                button = Gtk.Button(
-                    icon_name = "user-trash-symbolic",
-                    vexpand = False,
-                    valign = 3,
-                    css_classes = ["error"]
-                )
-                button.connect("clicked", lambda button=button, model_name=model["name"]: dialogs.delete_model(self, model_name))
-                model_row.add_suffix(button)
-                self.local_model_list_box.append(model_row)
-
-                self.model_string_list.append(model["name"])
-                self.local_models.append(model["name"])
-            self.model_drop_down.set_selected(0)
-            self.verify_if_image_can_be_used()
-            return
+    def set_message_image(self, image, thumbnail):
+        if thumbnail is None:
+            image.set_from_icon_name("image-missing-symbolic")
         else:
+            image.set_from_paintable(Gdk.Texture.new_from_bytes(GLib.Bytes.new(thumbnail)))
+
+    def run_async(self, coroutine, callback:callable=None):
+        # Runs a connection_handler coroutine on the network thread, callback gets its result on the main thread
+        # unless the returned future gets cancelled first
+        future = connection_handler.submit(coroutine)
+        if callback: future.add_done_callback(lambda future: GLib.idle_add(self.async_done, future, callback))
+        return future
+
+    def async_done(self, future, callback:callable):
+        if future.cancelled(): return
+        try: result = future.result()
+        except Exception as e:
+            print(e)
+            return
+        callback(result)
+
+    def update_list_local_models(self, force:bool=False):
+        # Skipped while the last list is still fresh, pulls, deletes and new connections force it
+        if force or not model_inventory.fresh(): self.run_async(connection_handler.tags(), self.on_local_models)
+
+    def local_model_subtitle(self, model_name:str) -> str:
+        subtitle = model_name.split(":")[1]
+        if model_name in model_inventory.loaded:
+            subtitle += " • " + _("Loaded, {} in memory").format(GLib.format_size(model_inventory.loaded[model_name].get("size", 0)))
+        if model_name in self.benchmarking:
+            subtitle += " • " + _("Benchmarking, {}%").format(round(self.benchmarking[model_name] * 100))
+        elif model_benchmark.get(model_name):
+            result = model_benchmark.get(model_name)
+            subtitle += " • " + _("{} tokens/s, reads {} tokens/s, first token in {}s, loads in {}s, up to {}").format(result["tokens_per_second"], result["prompt_tokens_per_second"], result["first_token"], result["load_time"], GLib.format_size(result["memory"]))
+        return subtitle
+
+    def refresh_local_model_row(self, model_name:str):
+        if model_name in self.local_model_rows: self.local_model_rows[model_name].set_subtitle(self.local_model_subtitle(model_name))
+
+    def create_local_model_row(self, model_name:str):
+        model_row = Adw.ActionRow(
+            title = model_name.split(":")[0],
+            subtitle = self.local_model_subtitle(model_name)
+        )
+        button = Gtk.Button(
+            icon_name = "user-trash-symbolic",
+            vexpand = False,
+            valign = 3,
+            css_classes = ["error"]
+        )
+        button.connect("clicked", lambda button=button, model_name=model_name: dialogs.delete_model(self, model_name))
+        benchmark_button = Gtk.Button(
+            icon_name = "system-run-symbolic",
+            tooltip_text = _("Benchmark"),
+            vexpand = False,
+            valign = 3,
+            css_classes = ["flat"]
+        )
+        benchmark_button.connect("clicked", lambda button, model_name=model_name: self.benchmark_model(model_name))
+        model_row.add_suffix(benchmark_button)
+        model_row.add_suffix(button)
+        return model_row
+
+    def benchmark_model(self, model_name:str):
+        if model_name in self.benchmarking: return
+        self.benchmarking[model_name] = 0
+        self.refresh_local_model_row(model_name)
+        self.run_async(model_benchmark.run(model_name, lambda fraction, model_name=model_name: self.benchmark_progress(model_name, fraction)), lambda result, model_name=model_name: self.benchmark_done(model_name, result))
+
+    def benchmark_progress(self, model_name:str, fraction:float):
+        # Called on the network thread
+        self.benchmarking[model_name] = fraction
+        GLib.idle_add(self.refresh_local_model_row, model_name)
+
+    def benchmark_done(self, model_name:str, result:dict):
+        del self.benchmarking[model_name]
+        if result:
+            model_benchmark.save(model_name, result)
+            self.show_toast("good", 5, self.manage_models_overlay)
+        else: self.show_toast("error", 10, self.manage_models_overlay)
+        self.refresh_local_model_row(model_name)
+        self.update_fastest_model()
+
+    def update_fastest_model(self):
+        model_name = model_benchmark.fastest(self.local_models, model_benchmark.latency_target) if model_benchmark.latency_target > 0 else None
+        if model_benchmark.latency_target == 0: subtitle = _("Set a latency target to get a suggestion")
+        elif model_name: subtitle = model_name
+        else: subtitle = _("No benchmarked model starts answering within the target")
+        self.fastest_model_row.set_subtitle(subtitle)
+        self.use_fastest_model_button.set_sensitive(model_name is not None)
+
+    def select_fastest_model(self):
+        if model_benchmark.latency_target == 0: return
+        model_name = model_benchmark.fastest(self.local_models, model_benchmark.latency_target)
+        if model_name in self.local_models: self.model_drop_down.set_selected(self.local_models.index(model_name))
+
+    @Gtk.Template.Callback()
+    def use_fastest_model(self, button):
+        self.select_fastest_model()
+
+    def on_local_models(self, response):
+        if response['status'] != 'ok':
+            model_inventory.invalidate()
             self.connection_error()
+            return
+        added, removed, changed = model_inventory.update(json.loads(response['text'])['models'])
+        for model_name in removed:
+            self.local_model_list_box.remove(self.local_model_rows.pop(model_name))
+        for model_name in added:
+            self.local_model_rows[model_name] = self.create_local_model_row(model_name)
+            self.local_model_list_box.append(self.local_model_rows[model_name])
+        for model_name in changed:
+            self.local_model_rows[model_name].set_subtitle(self.local_model_subtitle(model_name))
+        self.local_model_list_box.set_visible(len(model_inventory.models) > 0)
+        if len(added) > 0 or len(removed) > 0:
+            # The selected model stays selected, the first time it's the one used last in the chat
+            selected_model = self.model_drop_down.get_selected_item().get_string() if self.model_drop_down.get_selected_item() else None
+            if selected_model is None and self.chats["selected_chat"] in self.chats["chats"] and len(self.get_messages()) > 0:
+                selected_model = self.get_messages()[-1]["model"]
+            self.local_models = list(model_inventory.models.keys())
+            self.model_string_list.splice(0, self.model_string_list.get_n_items(), self.local_models)
+            self.model_drop_down.set_selected(self.local_models.index(selected_model) if selected_model in self.local_models else 0)
+            self.verify_if_image_can_be_used()
+            self.update_fastest_model()
+
+    async def poll_loaded_models(self):
+        while True:
+            response = await connection_handler.ps()
+            if response['status'] == 'ok': GLib.idle_add(self.update_loaded_models, json.loads(response['text'])['models'])
+            await asyncio.sleep(model_inventory.ps_interval)
+
+    def update_loaded_models(self, models:list):
+        for model_name in model_inventory.update_loaded(models): self.refresh_local_model_row(model_name)
 
     def save_server_config(self):
-        with open(os.path.join(self.config_dir, "server.json"), "w+") as f:
-            json.dump({'remote_url': self.remote_url, 'run_remote': self.run_remote, 'local_port': local_instance.port, 'run_on_background': self.run_on_background, 'model_tweaks': self.model_tweaks}, f)
+        data = json.dumps({'remote_url': self.remote_url, 'run_remote': self.run_remote, 'local_port': local_instance.port, 'run_on_background': self.run_on_background, 'model_tweaks': dict(self.model_tweaks), 'compare_parallel': self.compare_parallel, 'idle_timeout': local_instance.idle_timeout, 'pool_size': local_instance.pool_size, 'latency_target': model_benchmark.latency_target})
+        persistence.schedule(os.path.join(self.config_dir, "server.json"), lambda: data)
 
-    def verify_connection(self):
-        response = connection_handler.simple_get(connection_handler.url)
-        if response['status'] == 'ok':
-            if "Ollama is running" in response['text']:
-                self.save_server_config()
-                self.update_list_local_models()
-                return True
-        return False
+    def verify_connection(self, callback:callable=None):
+        self.run_async(connection_handler.check(), lambda response, callback=callback: self.connection_verified(response, callback))
+
+    def connection_verified(self, response, callback:callable):
+        connected = response['status'] == 'ok' and "Ollama is running" in response['text']
+        if connected:
+            self.save_server_config()
+            self.update_list_local_models(True)
+        if callback: callback(connected)
 
+    def connection_checked(self, connected):
+        if not connected: self.connection_error()
+
+    @tracing.traced("add code blocks", "ui")
     def add_code_blocks(self):
         text = self.bot_message.get_text(self.bot_message.get_start_iter(), self.bot_message.get_end_iter(), True)
         GLib.idle_add(self.bot_message_view.get_parent().remove, self.bot_message_view)
-        # Define a regular expression pattern to match code blocks
-        code_block_pattern = re.compile(r'```(\w+)\n(.*?)\n```', re.DOTALL)
-        parts = []
-        pos = 0
-        for match in code_block_pattern.finditer(text):
-            start, end = match.span()
-            if pos < start:
-                normal_text = text[pos:start]
-                parts.append({"type": "normal", "text": normal_text.strip()})
-            language = match.group(1)
-            code_text = match.group(2)
-            parts.append({"type": "code", "text": code_text, "language": language})
-            pos = end
-        # Extract any remaining normal text after the last code block
-        if pos < len(text):
-            normal_text = text[pos:]
-            if normal_text.strip():
-                parts.append({"type": "normal", "text": normal_text.strip()})
-        bold_pattern = re.compile(r'\*\*(.*?)\*\*') #"**text**"
-        code_pattern = re.compile(r'`(.*?)`') #"`text`"
-        h1_pattern = re.compile(r'^#\s(.*)$') #"# text"
-        h2_pattern = re.compile(r'^##\s(.*)$') #"## text"
-        markup_pattern = re.compile(r'<(b|u|tt|span.*)>(.*?)<\/(b|u|tt|span)>') #heh butt span, I'm so funny
+        parts = message_parser.parse(text)
         for part in parts:
             if part['type'] == 'normal':
                 message_text = Gtk.TextView(
@@ -460,49 +717,26 @@ class AlpacaWindow(Adw.ApplicationWindow):
                 )
                 message_buffer = message_text.get_buffer()
 
-                footer = None
-                if part['text'].split("\n")[-1] == parts[-1]['text'].split("\n")[-1]:
-                    footer = "\n<small>" + part['text'].split('\n')[-1] + "</small>"
-                    part['text'] = '\n'.join(part['text'].split("\n")[:-1])
-
-                part['text'] = part['text'].replace("\n* ", "\n• ")
-                #part['text'] = GLib.markup_escape_text(part['text'])
-                part['text'] = code_pattern.sub(r'<tt>\1</tt>', part['text'])
-                part['text'] = bold_pattern.sub(r'<b>\1</b>', part['text'])
-                part['text'] = h1_pattern.sub(r'<span size="x-large">\1</span>', part['text'])
-                part['text'] = h2_pattern.sub(r'<span size="large">\1</span>', part['text'])
-
-                position = 0
-                for match in markup_pattern.finditer(part['text']):
-                    start, end = match.span()
-                    if position < start:
-                        message_buffer.insert(message_buffer.get_end_iter(), part['text'][position:start])
-                    message_buffer.insert_markup(message_buffer.get_end_iter(), match.group(0), len(match.group(0)))
-                    position = end
-
-                if position < len(part['text']):
-                    message_buffer.insert(message_buffer.get_end_iter(), part['text'][position:])
-
-                if footer: message_buffer.insert_markup(message_buffer.get_end_iter(), footer, len(footer))
+                for is_markup, text in part['spans']:
+                    if is_markup: message_buffer.insert_markup(message_buffer.get_end_iter(), text, len(text))
+                    else: message_buffer.insert(message_buffer.get_end_iter(), text)
+                if part['footer']: message_buffer.insert_markup(message_buffer.get_end_iter(), part['footer'], len(part['footer']))
 
                 self.bot_message_box.append(message_text)
             else:
+                GtkSource = code_theme.source()
                 language = GtkSource.LanguageManager.get_default().get_language(part['language'])
                 if language:
                     buffer = GtkSource.Buffer.new_with_language(language)
                 else:
                     buffer = GtkSource.Buffer()
                 buffer.set_text(part['text'])
-                if self.style_manager.get_dark():
-                    source_style = GtkSource.StyleSchemeManager.get_default().get_scheme('Adwaita-dark')
-                else:
-                    source_style = GtkSource.StyleSchemeManager.get_default().get_scheme('Adwaita')
-                buffer.set_style_scheme(source_style)
                 source_view = GtkSource.View(
                     auto_indent=True, indent_width=4, buffer=buffer, show_line_numbers=True,
                     top_margin=6, bottom_margin=6, left_margin=12, right_margin=12
                 )
                 source_view.set_editable(False)
+                code_theme.register(buffer, source_view)
                 code_block_box = Gtk.Box(css_classes=["card"], orientation=1, overflow=1)
                 title_box = Gtk.Box(margin_start=12, margin_top=3, margin_bottom=3, margin_end=3)
                 title_box.append(Gtk.Label(label=language.get_name() if language else part['language'], hexpand=True, xalign=0))
@@ -513,19 +747,11 @@ class AlpacaWindow(Adw.ApplicationWindow):
                 code_block_box.append(Gtk.Separator())
                 code_block_box.append(source_view)
                 self.bot_message_box.append(code_block_box)
-                self.style_manager.connect("notify::dark", self.on_theme_changed, buffer)
         vadjustment = self.chat_window.get_vadjustment()
         vadjustment.set_value(vadjustment.get_upper())
         self.bot_message = None
         self.bot_message_box = None
 
-    def on_theme_changed(self, manager, dark, buffer):
-        if manager.get_dark():
-            source_style = GtkSource.StyleSchemeManager.get_default().get_scheme('Adwaita-dark')
-        else:
-            source_style = GtkSource.StyleSchemeManager.get_default().get_scheme('Adwaita')
-        buffer.set_style_scheme(source_style)
-
     def on_copy_code_clicked(self, btn, text_buffer):
         clipboard = Gdk.Display().get_default().get_clipboard()
         start = text_buffer.get_start_iter()
@@ -534,30 +760,139 @@ class AlpacaWindow(Adw.ApplicationWindow):
         clipboard.set(text)
         self.show_toast("info", 4, self.main_overlay)
 
-    def update_bot_message(self, data):
-        if self.bot_message is None:
-            self.save_history()
-            sys.exit()
-        vadjustment = self.chat_window.get_vadjustment()
-        if self.chats["chats"][self.chats["selected_chat"]]["messages"][-1]['role'] == "user" or vadjustment.get_value() + 50 >= vadjustment.get_upper() - vadjustment.get_page_size():
-            GLib.idle_add(vadjustment.set_value, vadjustment.get_upper())
-        if data['done']:
-            formated_datetime = datetime.now().strftime("%Y/%m/%d %H:%M")
-            text = f"\n<small>{data['model']}\t|\t{formated_datetime}</small>"
-            GLib.idle_add(self.bot_message.insert_markup, self.bot_message.get_end_iter(), text, len(text))
-            self.save_history()
-        else:
-            if self.chats["chats"][self.chats["selected_chat"]]["messages"][-1]['role'] == "user":
-                GLib.idle_add(self.chat_container.remove, self.loading_spinner)
-                self.loading_spinner = None
-                self.chats["chats"][self.chats["selected_chat"]]["messages"].append({
-                    "role": "assistant",
-                    "model": data['model'],
-                    "date": datetime.now().strftime("%Y/%m/%d %H:%M"),
-                    "content": ''
-                })
-            GLib.idle_add(self.bot_message.insert, self.bot_message.get_end_iter(), data['message']['content'])
-            self.chats["chats"][self.chats["selected_chat"]]["messages"][-1]['content'] += data['message']['content']
+    def update_bot_message(self, batch):
+        # Called on the network thread, every event that arrived in the same read is inserted with a single idle callback.
+        # While the window is hidden the reply only goes to chat_store, the lock keeps it from being shown again halfway
+        if self.bot_message is None: return
+        with chat_store.lock:
+            if not self.rendering: self.transcript_stale = True
+            if self.rendering:
+                vadjustment = self.chat_window.get_vadjustment()
+                if self.get_messages()[-1]['role'] == "user" or vadjustment.get_value() + 50 >= vadjustment.get_upper() - vadjustment.get_page_size():
+                    GLib.idle_add(vadjustment.set_value, vadjustment.get_upper())
+            content = ''.join(data['message']['content'] for data in batch if not data['done'])
+            if content:
+                first_token = self.get_messages()[-1]['role'] == "user"
+                if first_token:
+                    if self.rendering: GLib.idle_add(self.chat_container.remove, self.loading_spinner)
+                    self.loading_spinner = None
+                    chat_store.add_message(self.chats["selected_chat"], {
+                        "id": self.bot_message_id,
+                        "role": "assistant",
+                        "model": batch[0]['model'],
+                        "date": datetime.now().strftime("%Y/%m/%d %H:%M"),
+                        "content": '',
+                        "partial": True
+                    })
+                if self.rendering:
+                    GLib.idle_add(self.bot_message.insert, self.bot_message.get_end_iter(), content)
+                    # Queued after the insert so it's recorded once the token is on screen
+                    if first_token: GLib.idle_add(tracing.instant, "first token rendered", "ui")
+                self.reply_chunks.append(content)
+            if batch[-1]['done']:
+                formated_datetime = datetime.now().strftime("%Y/%m/%d %H:%M")
+                text = f"\n<small>{batch[-1]['model']}\t|\t{formated_datetime}</small>"
+                if self.rendering: GLib.idle_add(self.bot_message.insert_markup, self.bot_message.get_end_iter(), text, len(text))
+                self.join_reply(True)
+                # Saved from the main thread, which is the one that changes self.chats
+                GLib.idle_add(self.save_history)
+            elif content and time() - self.last_checkpoint > chat_store.checkpoint_interval:
+                # So a crash only loses the last few seconds of the reply
+                self.last_checkpoint = time()
+                self.join_reply()
+                GLib.idle_add(self.save_history)
+
+    def compare_insert(self, buffer, text):
+        buffer.insert(buffer.get_end_iter(), text)
+
+    async def compare_model_process(self, model, messages, column, semaphore):
+        async with semaphore:
+            stats = {"start": time(), "first_token": None}
+            GLib.idle_add(column['stats'].set_label, _("Generating..."))
+
+            def update(batch):
+                content = ''.join(data['message']['content'] for data in batch if not data['done'])
+                if content:
+                    if stats['first_token'] is None: stats['first_token'] = time()
+                    GLib.idle_add(self.compare_insert, column['buffer'], content)
+                if batch[-1]['done']:
+                    data = batch[-1]
+                    first_token = (stats['first_token'] or time()) - stats['start']
+                    tokens_per_second = data['eval_count'] / (data['eval_duration'] / 1e9) if data.get('eval_duration') else 0
+                    GLib.idle_add(column['stats'].set_label, _("First token: {:.2f}s | {:.1f} tokens/s").format(first_token, tokens_per_second))
+
+            data = {
+                "model": model,
+                "messages": messages,
+                "options": {"temperature": self.model_tweaks["temperature"], "seed": self.model_tweaks["seed"]},
+                "keep_alive": f"{self.model_tweaks['keep_alive']}m"
+            }
+            response = await connection_handler.chat(data, update)
+            if response['status'] == 'error':
+                GLib.idle_add(column['stats'].set_label, _("An error occurred"))
+
+    async def compare_process(self, models, messages, columns, parallel):
+        # Models that are already loaded go first so the rest are loaded (at most) once each
+        response = await connection_handler.ps(scheduler.NORMAL)
+        loaded_models = [model['name'] for model in json.loads(response['text'])['models']] if response['status'] == 'ok' else []
+        models = sorted(models, key=lambda model: model not in loaded_models)
+        semaphore = asyncio.Semaphore(max(1, parallel))
+        await asyncio.gather(*[self.compare_model_process(model, messages, columns[model], semaphore) for model in models])
+
+    def compare_models(self, models):
+        buffer = self.message_text_view.get_buffer()
+        prompt = buffer.get_text(buffer.get_start_iter(), buffer.get_end_iter(), False)
+        if not prompt:
+            self.show_toast("info", 6, self.main_overlay)
+            return
+        messages = chat_store.request_messages(self.get_messages())
+        messages.append({"role": "user", "content": prompt})
+        columns = {}
+        column_container = Gtk.Box(
+            orientation=0,
+            spacing=12,
+            homogeneous=True,
+            margin_top=12,
+            margin_bottom=12,
+            margin_start=12,
+            margin_end=12
+        )
+        for model in models:
+            column = Gtk.Box(
+                orientation=1,
+                spacing=6,
+                width_request=300,
+                css_classes=["card"]
+            )
+            column.append(Gtk.Label(label=model, css_classes=["heading"], xalign=0, ellipsize=3, margin_top=12, margin_start=12, margin_end=12))
+            stats_label = Gtk.Label(label=_("Waiting..."), css_classes=["dim-label", "caption"], xalign=0, margin_start=12, margin_end=12)
+            column.append(stats_label)
+            column.append(Gtk.Separator())
+            text_view = Gtk.TextView(
+                editable=False,
+                focusable=True,
+                wrap_mode= Gtk.WrapMode.WORD,
+                margin_top=6,
+                margin_bottom=12,
+                margin_start=12,
+                margin_end=12,
+                vexpand=True,
+                css_classes=["flat"]
+            )
+            column.append(text_view)
+            column_container.append(column)
+            columns[model] = {"stats": stats_label, "buffer": text_view.get_buffer()}
+        toolbar_view = Adw.ToolbarView(content=Gtk.ScrolledWindow(child=column_container, vexpand=True, hexpand=True))
+        toolbar_view.add_top_bar(Adw.HeaderBar())
+        dialog = Adw.Dialog(
+            title=_("Compare Models"),
+            content_width=min(1200, 324 * len(models) + 12),
+            content_height=700,
+            child=toolbar_view
+        )
+        task = self.run_async(self.compare_process(models, messages, columns, self.compare_parallel))
+        dialog.connect("closed", lambda dialog, task=task: task.cancel())
+        dialog.present(self)
 
     def toggle_ui_sensitive(self, status):
         for element in [self.chat_list_box, self.add_chat_button]:
@@ -568,44 +903,56 @@ class AlpacaWindow(Adw.ApplicationWindow):
         self.send_button.set_visible(not self.send_button.get_visible())
 
     def run_message(self, messages, model):
-        response = connection_handler.stream_post(f"{connection_handler.url}/api/chat", data=json.dumps({"model": model, "messages": messages}), callback=self.update_bot_message)
-        GLib.idle_add(self.add_code_blocks)
-        GLib.idle_add(self.switch_send_stop_button)
-        GLib.idle_add(self.toggle_ui_sensitive, True)
-        if self.verify_if_image_can_be_used(): GLib.idle_add(self.image_button.set_sensitive, True)
-        GLib.idle_add(self.image_button.set_css_classes, ["circular"])
-        self.attached_image = {"path": None, "base64": None}
+        self.message_task = self.run_async(connection_handler.chat({"model": model, "messages": messages}, self.update_bot_message), self.message_done)
+
+    def message_done(self, response):
+        if self.message_task is None: return # Stopped by the user
+        self.message_task = None
+        # Still partial if the stream failed, it can be resumed
+        if response['status'] == 'error': self.join_reply()
+        messages = self.get_messages()
+        if self.rendering: self.add_code_blocks()
+        else:
+            # Drawn when the window is shown again
+            self.bot_message = None
+            self.bot_message_box = None
+            self.transcript_stale = True
+            if response['status'] == 'ok' and len(messages) > 0 and messages[-1]['role'] == 'assistant':
+                self.show_notification(_("Response Ready"), _("{} finished replying in '{}'").format(messages[-1]['model'], self.chats["chats"][self.chats["selected_chat"]]["name"]), False, Gio.ThemedIcon.new("chat-message-new-symbolic"))
+        tracing.end("chat turn", self.turn_trace, "chat", status=response['status'])
+        self.turn_trace = None
+        if self.rendering and len(messages) > 0 and len(chat_store.children(chat_store.get_tree(self.chats["selected_chat"]))[messages[-1]['parent']]) > 1:
+            # A new branch, shown again so it gets its branch buttons
+            self.load_history_into_chat()
+        self.switch_send_stop_button()
+        self.toggle_ui_sensitive(True)
+        if self.verify_if_image_can_be_used(): self.image_button.set_sensitive(True)
+        self.remove_images()
         if response['status'] == 'error':
-            GLib.idle_add(self.connection_error)
+            self.connection_error()
             print(response)
 
     def pull_model_update(self, data, model_name):
-        if model_name in list(self.pulling_models.keys()):
+        # Called on the network thread, nobody sees the progress while the window is hidden
+        if self.rendering and model_name in list(self.pulling_models.keys()):
             GLib.idle_add(self.pulling_models[model_name]['row'].set_subtitle, data['status'])
             if 'completed' in data and 'total' in data: GLib.idle_add(self.pulling_models[model_name]['progress_bar'].set_fraction, (data['completed'] / data['total']))
             else: GLib.idle_add(self.pulling_models[model_name]['progress_bar'].pulse)
-        else:
-            if len(list(self.pulling_models.keys())) == 0:
-                GLib.idle_add(self.pulling_model_list_box.set_visible, False)
-
-    def pull_model_process(self, model):
-        data = {"name":model}
-        response = connection_handler.stream_post(f"{connection_handler.url}/api/pull", data=json.dumps(data), callback=lambda data, model_name=model: self.pull_model_update(data, model_name))
-        GLib.idle_add(self.update_list_local_models)
 
-        if response['status'] == 'ok':
-            GLib.idle_add(self.show_notification, _("Task Complete"), _("Model '{}' pulled successfully.").format(model), True, Gio.ThemedIcon.new("emblem-ok-symbolic"))
-            GLib.idle_add(self.show_toast, "good", 1, self.manage_models_overlay)
-            GLib.idle_add(self.pulling_models[model]['overlay'].get_parent().get_parent().remove, self.pulling_models[model]['overlay'].get_parent())
+    def pull_model_done(self, model, response):
+        self.update_list_local_models(True)
+        if model in self.pulling_models:
+            self.pulling_models[model]['overlay'].get_parent().get_parent().remove(self.pulling_models[model]['overlay'].get_parent())
             del self.pulling_models[model]
+        if response['status'] == 'ok':
+            self.show_notification(_("Task Complete"), _("Model '{}' pulled successfully.").format(model), True, Gio.ThemedIcon.new("emblem-ok-symbolic"))
+            self.show_toast("good", 1, self.manage_models_overlay)
         else:
-            GLib.idle_add(self.show_notification, _("Pull Model Error"), _("Failed to pull model '{}' due to network error.").format(model), True, Gio.ThemedIcon.new("dialog-error-symbolic"))
-            GLib.idle_add(self.pulling_models[model]['overlay'].get_parent().get_parent().remove, self.pulling_models[model]['overlay'].get_parent())
-            del self.pulling_models[model]
-            GLib.idle_add(self.manage_models_dialog.close)
-            GLib.idle_add(self.connection_error)
+            self.show_notification(_("Pull Model Error"), _("Failed to pull model '{}' due to network error.").format(model), True, Gio.ThemedIcon.new("dialog-error-symbolic"))
+            self.manage_models_dialog.close()
+            self.connection_error()
         if len(list(self.pulling_models.keys())) == 0:
-            GLib.idle_add(self.pulling_model_list_box.set_visible, False)
+            self.pulling_model_list_box.set_visible(False)
 
     def pull_model(self, model):
         if model in list(self.pulling_models.keys()):
@@ -618,7 +965,6 @@ class AlpacaWindow(Adw.ApplicationWindow):
         model_row = Adw.ActionRow(
             title = model
         )
-        thread = threading.Thread(target=self.pull_model_process, kwargs={"model": model})
         overlay = Gtk.Overlay()
         progress_bar = Gtk.ProgressBar(
             valign = 2,
@@ -640,9 +986,11 @@ class AlpacaWindow(Adw.ApplicationWindow):
         overlay.set_child(model_row)
         overlay.add_overlay(progress_bar)
         self.pulling_model_list_box.append(overlay)
-        thread.start()
+        self.pulling_models[model]['task'] = self.run_async(connection_handler.pull(model, lambda batch, model_name=model: self.pull_model_update(batch[-1], model_name)), lambda response, model_name=model: self.pull_model_done(model_name, response))
 
     def update_list_available_models(self):
+        from .available_models import available_models
+        self.available_models_listed = True
         self.available_model_list_box.remove_all()
         for name, model_info in available_models.items():
             model = Adw.ActionRow(
@@ -661,117 +1009,206 @@ class AlpacaWindow(Adw.ApplicationWindow):
                 valign = 3,
                 css_classes = ["accent"]
             )
-            link_button.connect("clicked", lambda button=link_button, link=model_info["url"]: webbrowser.open(link))
+            link_button.connect("clicked", lambda button=link_button, link=model_info["url"]: Gio.AppInfo.launch_default_for_uri(link, None))
             pull_button.connect("clicked", lambda button=pull_button, model_name=name: dialogs.pull_model(self, model_name))
             model.add_suffix(link_button)
             model.add_suffix(pull_button)
             self.available_model_list_box.append(model)
 
+    def get_messages(self, chat_id:str=None) -> list:
+        return chat_store.get_messages(chat_id if chat_id else self.chats["selected_chat"])
+
+    @tracing.traced("save history", "storage")
     def save_history(self):
-        with open(os.path.join(self.config_dir, "chats.json"), "w+") as f:
-            json.dump(self.chats, f, indent=4)
+        chat_store.save(self.chats, [self.chats["selected_chat"]])
+
+    def visibility_changed(self):
+        if not self.get_visible():
+            self.rendering = False
+            return
+        with chat_store.lock:
+            if self.transcript_stale: self.rebuild_transcript()
+            self.rendering = True
+
+    def rebuild_transcript(self):
+        # Catches the chat up with what was received while the window was hidden, a reply that is still
+        # being generated gets a live view again
+        self.transcript_stale = False
+        if self.message_task: self.join_reply()
+        self.load_history_into_chat()
+        if self.message_task is None: return
+        messages = self.get_messages()
+        content = ''
+        if len(messages) > 0 and messages[-1]['id'] == self.bot_message_id:
+            content = messages[-1]['content']
+            self.chat_container.remove(self.chat_container.get_last_child())
+        else:
+            self.loading_spinner = Gtk.Spinner(spinning=True, margin_top=12, margin_bottom=12, hexpand=True)
+            self.chat_container.append(self.loading_spinner)
+        self.show_message(content, True, id=self.bot_message_id)
+        GLib.idle_add(self.chat_window.get_vadjustment().set_value, self.chat_window.get_vadjustment().get_upper())
 
     def load_history_into_chat(self):
         for widget in list(self.chat_container): self.chat_container.remove(widget)
-        for i, message in enumerate(self.chats['chats'][self.chats["selected_chat"]]['messages']):
-            if message:
-                if message['role'] == 'user':
-                    self.show_message(message['content'], False, f"\n\n<small>{message['date']}</small>", message['images'][0] if 'images' in message and len(message['images']) > 0 else None, id=i)
-                else:
-                    self.show_message(message['content'], True, f"\n\n<small>{message['model']}\t|\t{message['date']}</small>", id=i)
-                    self.add_code_blocks()
-                    self.bot_message = None
+        branches = chat_store.children(chat_store.get_tree(self.chats["selected_chat"]))
+        messages = self.get_messages()
+        for message in messages:
+            siblings = branches[message['parent']]
+            branch = (siblings.index(message['id']) + 1, len(siblings)) if len(siblings) > 1 else None
+            if message['role'] == 'user':
+                self.show_message(message['content'], False, f"\n\n<small>{message['date']}</small>", message.get('images'), id=message['id'], branch=branch)
+            else:
+                # A reply that was cut off by a crash, an error or the stop button can be continued
+                resumable = message.get('partial', False) and message is messages[-1]
+                self.show_message(message['content'], True, f"\n\n<small>{message['model']}\t|\t{message['date']}</small>", id=message['id'], branch=branch, resumable=resumable)
+                self.add_code_blocks()
+                self.bot_message = None
 
+    @tracing.traced("load history", "startup")
     def load_history(self):
-        if os.path.exists(os.path.join(self.config_dir, "chats.json")):
-            try:
-                with open(os.path.join(self.config_dir, "chats.json"), "r") as f:
-                    self.chats = json.load(f)
-                    if "selected_chat" not in self.chats or self.chats["selected_chat"] not in self.chats["chats"]: self.chats["selected_chat"] = list(self.chats["chats"].keys())[0]
-                    if len(list(self.chats["chats"].keys())) == 0: self.chats["chats"][_("New Chat")] = {"messages": []}
-                    for chat_name, content in self.chats['chats'].items():
-                        for i, content in enumerate(content['messages']):
-                            if not content: del self.chats['chats'][chat_name]['messages'][i]
-            except Exception as e:
-                self.chats = {"chats": {_("New Chat"): {"messages": []}}, "selected_chat": _("New Chat")}
-            self.load_history_into_chat()
+        try:
+            self.chats = chat_store.load() or {"chats": {}, "selected_chat": None}
+        except Exception as e:
+            print(e)
+            self.chats = {"chats": {}, "selected_chat": None}
+        if len(self.chats["chats"]) == 0: self.chats["chats"][chat_store.new_id()] = chat_store.new_chat(_("New Chat"))
+        if self.chats.get("selected_chat") not in self.chats["chats"]: self.chats["selected_chat"] = max(self.chats["chats"], key=lambda chat_id: self.chats["chats"][chat_id]["last_activity"])
+        self.load_history_into_chat()
 
     def load_image(self, file_dialog, result):
-        try: file = file_dialog.open_finish(result)
+        try: files = file_dialog.open_multiple_finish(result)
         except: return
-        try:
-            self.attached_image["path"] = file.get_path()
-            with Image.open(self.attached_image["path"]) as img:
-                width, height = img.size
-                max_size = 240
-                if width > height:
-                    new_width = max_size
-                    new_height = int((max_size / width) * height)
-                else:
-                    new_height = max_size
-                    new_width = int((max_size / height) * width)
-                resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-                with BytesIO() as output:
-                    resized_img.save(output, format="PNG")
-                    image_data = output.getvalue()
-                self.attached_image["base64"] = base64.b64encode(image_data).decode("utf-8")
-
-            self.image_button.set_css_classes(["destructive-action", "circular"])
-        except Exception as e:
+        self.attach_images([file.get_path() for file in files])
+
+    def attach_images(self, paths:list):
+        paths = [image["path"] for image in self.attached_images] + [path for path in paths if path]
+        if not self.verify_if_image_can_be_used() or len(paths) == len(self.attached_images): return
+        self.image_button.set_sensitive(False)
+        # Every image is encoded again (or taken from the cache) so the size cap covers the whole message
+        image_cache.load(paths, image_cache.input_size(self.model_drop_down.get_selected_item().get_string()), lambda images: GLib.idle_add(self.on_images_loaded, images))
+
+    def on_images_loaded(self, images):
+        self.image_button.set_sensitive(self.verify_if_image_can_be_used())
+        if images is None:
             self.show_toast("error", 5, self.main_overlay)
+        elif self.image_button.get_sensitive():
+            self.attached_images = images
+            self.update_attachments()
+
+    def update_attachments(self):
+        for widget in list(self.attachment_box): self.attachment_box.remove(widget)
+        for image in self.attached_images:
+            image_widget = Gtk.Image(pixel_size=64)
+            image_cache.thumbnail(image["base64"], lambda thumbnail, image_widget=image_widget: GLib.idle_add(self.set_message_image, image_widget, thumbnail))
+            button = Gtk.Button(
+                child=image_widget,
+                tooltip_text=_("Remove image"),
+                css_classes=["flat"]
+            )
+            button.connect("clicked", lambda button, image=image: dialogs.remove_image(self, image))
+            self.attachment_box.append(button)
+        self.attachment_container.set_visible(len(self.attached_images) > 0)
+
+    def remove_image(self, image):
+        if image in self.attached_images:
+            self.attached_images.remove(image)
+            self.update_attachments()
 
-    def remove_image(self):
-        self.image_button.set_css_classes(["circular"])
-        self.attached_image = {"path": None, "base64": None}
+    def remove_images(self):
+        self.attached_images = []
+        self.update_attachments()
+
+    def on_image_dropped(self, drop_target, value, x, y):
+        if not self.verify_if_image_can_be_used(): return False
+        self.attach_images([file.get_path() for file in value.get_files()])
+        return True
 
     def generate_numbered_chat_name(self, chat_name) -> str:
-        if chat_name in self.chats["chats"]:
-            for i in range(len(list(self.chats["chats"].keys()))):
-                if chat_name + f" {i+1}" not in self.chats["chats"]:
-                    chat_name += f" {i+1}"
-                    break
-        return chat_name
+        return chat_store.generate_numbered_name(self.chats, chat_name)
+
+    def add_chat_item(self, chat_id:str, select:bool):
+        chat = self.chats["chats"][chat_id]
+        item = ChatItem(id=chat_id, name=chat["name"], last_activity=chat["last_activity"])
+        self.chat_items[chat_id] = item
+        self.chat_list_model.insert_sorted(item, self.compare_chat_items)
+        if select: self.select_chat_row(chat_id)
+
+    def select_chat_row(self, chat_id:str):
+        if chat_id in self.chat_rows: self.chat_list_box.select_row(self.chat_rows[chat_id])
+
+    def update_chat_activity(self, chat_id:str, last_activity:str):
+        self.chats["chats"][chat_id]["last_activity"] = last_activity
+        self.chat_items[chat_id].set_property("last_activity", last_activity)
+        self.sort_chat_item(chat_id)
+
+    def sort_chat_item(self, chat_id:str):
+        item = self.chat_items[chat_id]
+        found, position = self.chat_list_model.find(item)
+        if not found: return
+        self.chat_list_model.remove(position)
+        self.chat_list_model.insert_sorted(item, self.compare_chat_items)
+        if chat_id == self.chats["selected_chat"]: self.select_chat_row(chat_id)
 
     def clear_chat(self):
         for widget in list(self.chat_container): self.chat_container.remove(widget)
-        self.chats["chats"][self.chats["selected_chat"]]["messages"] = []
+        chat_store.set_messages(self.chats["selected_chat"], [])
         self.save_history()
 
-    def delete_chat(self, chat_name):
-        del self.chats['chats'][chat_name]
-        self.save_history()
-        self.update_chat_list()
+    def delete_chat(self, chat_id):
+        del self.chats['chats'][chat_id]
+        chat_store.delete(chat_id)
+        found, position = self.chat_list_model.find(self.chat_items.pop(chat_id))
+        if found: self.chat_list_model.remove(position)
+        self.chat_rows.pop(chat_id, None)
         if len(self.chats['chats'])==0:
             self.new_chat()
+        elif chat_id == self.chats["selected_chat"]:
+            self.chat_list_box.select_row(self.chat_list_box.get_row_at_index(0))
+        self.save_history()
 
-    def rename_chat(self, old_chat_name, new_chat_name, label_element):
+    def rename_chat(self, chat_id, new_chat_name):
         new_chat_name = self.generate_numbered_chat_name(new_chat_name)
-        self.chats["chats"][new_chat_name] = self.chats["chats"][old_chat_name]
-        del self.chats["chats"][old_chat_name]
-        label_element.set_label(new_chat_name)
-        label_element.get_parent().set_name(new_chat_name)
+        self.chats["chats"][chat_id]["name"] = new_chat_name
+        self.chat_items[chat_id].set_property("name", new_chat_name)
         self.save_history()
 
     def new_chat(self):
-        chat_name = self.generate_numbered_chat_name(_("New Chat"))
-        self.chats["chats"][chat_name] = {"messages": []}
+        chat_id = chat_store.new_id()
+        self.chats["chats"][chat_id] = chat_store.new_chat(self.generate_numbered_chat_name(_("New Chat")))
         self.save_history()
-        self.new_chat_element(chat_name, True)
+        self.add_chat_item(chat_id, True)
+        # New chats start with the fastest model that fits the latency target
+        self.select_fastest_model()
 
     def stop_pull_model(self, model_name):
+        self.pulling_models[model_name]['task'].cancel()
         self.pulling_models[model_name]['overlay'].get_parent().get_parent().remove(self.pulling_models[model_name]['overlay'].get_parent())
         del self.pulling_models[model_name]
 
     def delete_model(self, model_name):
-        response = connection_handler.simple_delete(connection_handler.url + "/api/delete", data={"name": model_name})
-        self.update_list_local_models()
+        self.run_async(connection_handler.delete_model(model_name), self.model_deleted)
+
+    def model_deleted(self, response):
+        self.update_list_local_models(True)
         if response['status'] == 'ok':
             self.show_toast("good", 0, self.manage_models_overlay)
         else:
             self.manage_models_dialog.close()
             self.connection_error()
 
-    def new_chat_element(self, chat_name:str, select:bool):
+    def compare_chat_items(self, item_a, item_b, user_data=None) -> int:
+        # Most recent activity first
+        if item_a.props.last_activity == item_b.props.last_activity: return 0
+        return -1 if item_a.props.last_activity > item_b.props.last_activity else 1
+
+    def chat_row_tooltip(self, chat_row, x, y, keyboard_mode, tooltip, chat_id):
+        if chat_id not in self.chats["chats"]: return False
+        chat = self.chats["chats"][chat_id]
+        tooltip.set_text(_("{} messages | {}").format(chat["message_count"], chat["last_activity"]))
+        return True
+
+    def create_chat_row(self, item):
+        chat_id = item.props.id
         chat_content = Gtk.Box(
             spacing=6
         )
@@ -779,10 +1216,11 @@ class AlpacaWindow(Adw.ApplicationWindow):
             css_classes = ["chat_row"],
             height_request = 45,
             child = chat_content,
-            name = chat_name
+            name = chat_id,
+            has_tooltip = True
         )
+        chat_row.connect("query-tooltip", self.chat_row_tooltip, chat_id)
         chat_label = Gtk.Label(
-            label=chat_name,
             hexpand=True,
             halign=0,
             wrap=True,
@@ -797,47 +1235,127 @@ class AlpacaWindow(Adw.ApplicationWindow):
             valign = 3,
             css_classes = ["error", "flat"]
         )
-        button_delete.connect("clicked", lambda button, chat_name=chat_name: dialogs.delete_chat(self, chat_name))
+        item.bind_property("name", chat_label, "label", GObject.BindingFlags.SYNC_CREATE)
+        button_delete.connect("clicked", lambda button, chat_id=chat_id: dialogs.delete_chat(self, chat_id))
         button_rename = Gtk.Button(
             icon_name = "document-edit-symbolic",
             vexpand = False,
             valign = 3,
             css_classes = ["accent", "flat"]
         )
-        chat_content.set_name(chat_name)
-        button_rename.connect("clicked", lambda button, label_element=chat_label: dialogs.rename_chat(self, label_element))
+        button_rename.connect("clicked", lambda button, chat_id=chat_id: dialogs.rename_chat(self, chat_id))
         chat_content.append(chat_label)
         chat_content.append(button_delete)
         chat_content.append(button_rename)
-        self.chat_list_box.append(chat_row)
-        if select: self.chat_list_box.select_row(chat_row)
+        self.chat_rows[chat_id] = chat_row
+        return chat_row
 
+    @tracing.traced("update chat list", "ui")
     def update_chat_list(self):
-        self.chat_list_box.remove_all()
-        for name, content in self.chats['chats'].items():
-            self.new_chat_element(name, self.chats["selected_chat"] == name)
+        self.chat_items = {}
+        items = []
+        for chat_id, chat in self.chats['chats'].items():
+            self.chat_items[chat_id] = ChatItem(id=chat_id, name=chat["name"], last_activity=chat["last_activity"])
+            items.append(self.chat_items[chat_id])
+        items.sort(key=lambda item: item.props.last_activity, reverse=True)
+        self.chat_list_model.splice(0, self.chat_list_model.get_n_items(), items)
+        self.select_chat_row(self.chats["selected_chat"])
+
+    def diagnostics_counters(self):
+        diagnostics.counters["message_widgets"] = lambda: len(list(self.chat_container))
+        diagnostics.counters["loaded_chats"] = lambda: len(chat_store.loaded_messages)
+        diagnostics.counters["code_buffers"] = lambda: len(code_theme.buffers)
+        diagnostics.counters["local_instance_memory"] = lambda: GLib.format_size(local_instance.memory_usage())
+        diagnostics.counters["requests"] = scheduler.stats
+
+    def on_diagnostics_saved(self, file_dialog, result):
+        try: file = file_dialog.save_finish(result)
+        except: return
+        data = json.dumps(diagnostics.report(), indent=4)
+        persistence.schedule(file.get_path(), lambda: data)
+        persistence.flush(file.get_path())
+
+    def on_trace_saved(self, file_dialog, result):
+        try: file = file_dialog.save_finish(result)
+        except: return
+        try: tracing.export(file.get_path())
+        except Exception as e: print(e)
+
+    def show_diagnostics(self):
+        diagnostics.enable()
+        text_view = Gtk.TextView(
+            editable=False,
+            monospace=True,
+            wrap_mode=Gtk.WrapMode.WORD_CHAR,
+            top_margin=12,
+            bottom_margin=12,
+            left_margin=12,
+            right_margin=12
+        )
+        refresh_button = Gtk.Button(icon_name="view-refresh-symbolic", tooltip_text=_("Refresh"))
+        refresh_button.connect("clicked", lambda button: text_view.get_buffer().set_text(diagnostics.format_report(diagnostics.report())))
+        save_button = Gtk.Button(icon_name="document-save-symbolic", tooltip_text=_("Save Report"))
+        save_button.connect("clicked", lambda button: Gtk.FileDialog(initial_name="alpaca-diagnostics.json").save(self, None, self.on_diagnostics_saved))
+        trace_button = Gtk.ToggleButton(icon_name="media-record-symbolic", tooltip_text=_("Record Trace"), active=tracing.enabled)
+        trace_button.connect("toggled", lambda button: setattr(tracing, "enabled", button.get_active()))
+        export_trace_button = Gtk.Button(icon_name="document-send-symbolic", tooltip_text=_("Export Trace"))
+        export_trace_button.connect("clicked", lambda button: Gtk.FileDialog(initial_name="alpaca-trace.json").save(self, None, self.on_trace_saved))
+        header_bar = Adw.HeaderBar()
+        header_bar.pack_start(refresh_button)
+        header_bar.pack_start(trace_button)
+        header_bar.pack_end(save_button)
+        header_bar.pack_end(export_trace_button)
+        toolbar_view = Adw.ToolbarView(content=Gtk.ScrolledWindow(child=text_view, vexpand=True, hexpand=True))
+        toolbar_view.add_top_bar(header_bar)
+        dialog = Adw.Dialog(
+            title=_("Diagnostics"),
+            content_width=800,
+            content_height=600,
+            child=toolbar_view
+        )
+        text_view.get_buffer().set_text(diagnostics.format_report(diagnostics.report()))
+        dialog.present(self)
 
     def show_preferences_dialog(self):
         self.preferences_dialog.present(self)
+        self.update_fastest_model()
+        self.update_local_instance_status()
+        GLib.timeout_add_seconds(5, self.update_local_instance_status)
+
+    def update_local_instance_status(self):
+        if self.run_remote: subtitle = _("Not used while connected to a remote instance")
+        elif local_instance.running(): subtitle = _("Running, using {} of memory").format(GLib.format_size(local_instance.memory_usage()))
+        else: subtitle = _("Stopped, it will start when it's needed")
+        self.local_instance_status_row.set_subtitle(subtitle)
+        return self.preferences_dialog.get_mapped()
+
+    def use_local_instance(self, local:bool):
+        # The local instance is started by the first request that needs it
+        if local:
+            connection_handler.url = f"http://127.0.0.1:{local_instance.port}"
+            connection_handler.request_hook = local_instance.in_use
+            scheduler.backend_limits[connection_handler.backend_name(connection_handler.url)] = scheduler.backend_limit * local_instance.pool_size
+        else:
+            connection_handler.request_hook = None
 
     def connect_remote(self, url):
+        self.use_local_instance(False)
         connection_handler.url = url
         self.remote_url = connection_handler.url
         self.remote_connection_entry.set_text(self.remote_url)
-        if self.verify_connection() == False: self.connection_error()
+        self.verify_connection(self.connection_checked)
 
     def connect_local(self):
         self.run_remote = False
-        connection_handler.url = f"http://127.0.0.1:{local_instance.port}"
-        local_instance.start()
-        if self.verify_connection() == False: self.connection_error()
-        else: self.remote_connection_switch.set_active(False)
+        self.use_local_instance(True)
+        self.verify_connection(lambda connected: self.remote_connection_switch.set_active(False) if connected else self.connection_error())
 
     def connection_error(self):
         if self.run_remote:
             dialogs.reconnect_remote(self, connection_handler.url)
         else:
-            local_instance.reset()
+            # The next request starts it again
+            connection_handler.submit(local_instance.shutdown())
             self.show_toast("error", 7, self.main_overlay)
 
     def connection_switched(self):
@@ -845,50 +1363,84 @@ class AlpacaWindow(Adw.ApplicationWindow):
         if new_value != self.run_remote:
             self.run_remote = new_value
             if self.run_remote:
+                self.use_local_instance(False)
                 connection_handler.url = self.remote_url
-                if self.verify_connection() == False: self.connection_error()
-                else: local_instance.stop()
+                self.verify_connection(lambda connected: connection_handler.submit(local_instance.shutdown()) if connected else self.connection_error())
             else:
-                connection_handler.url = f"http://127.0.0.1:{local_instance.port}"
-                local_instance.start()
-                if self.verify_connection() == False: self.connection_error()
+                self.use_local_instance(True)
+                self.verify_connection(self.connection_checked)
             self.update_list_available_models()
 
-    def on_replace_contents(self, file, result):
-        file.replace_contents_finish(result)
-        self.show_toast("good", 2, self.main_overlay)
+    def update_transfer_progress(self, text:str, fraction:float):
+        self.transfer_progress_bar.set_visible(fraction < 1)
+        self.transfer_progress_bar.set_text(text)
+        self.transfer_progress_bar.set_fraction(fraction)
+
+    def transfer_process(self, text:str, function:callable, callback:callable, *args):
+        try: result = function(*args, lambda fraction: GLib.idle_add(self.update_transfer_progress, text, fraction))
+        except Exception as e:
+            print(e)
+            result = e
+        GLib.idle_add(self.update_transfer_progress, text, 1)
+        GLib.idle_add(callback, result)
+
+    def start_transfer(self, text:str, function:callable, callback:callable, *args):
+        self.update_transfer_progress(text, 0)
+        thread = threading.Thread(target=self.transfer_process, args=(text, function, callback, *args))
+        thread.start()
+
+    def on_chat_exported(self, result):
+        if isinstance(result, Exception): self.show_toast("error", 8, self.main_overlay)
+        else: self.show_toast("good", 2, self.main_overlay)
+
+    def on_all_chats_exported(self, result):
+        if isinstance(result, Exception): self.show_toast("error", 8, self.main_overlay)
+        else: self.show_toast("good", 4, self.main_overlay)
 
     def on_export_current_chat(self, file_dialog, result):
-        file = file_dialog.save_finish(result)
-        data_to_export = {self.chats["selected_chat"]: self.chats["chats"][self.chats["selected_chat"]]}
-        file.replace_contents_async(
-            json.dumps(data_to_export, indent=4).encode("UTF-8"),
-            etag=None,
-            make_backup=False,
-            flags=Gio.FileCreateFlags.NONE,
-            cancellable=None,
-            callback=self.on_replace_contents
-        )
+        try: file = file_dialog.save_finish(result)
+        except: return
+        chat = self.chats["chats"][self.chats["selected_chat"]]
+        self.start_transfer(_("Exporting chat..."), chat_archive.export_chat, self.on_chat_exported, file.get_path(), chat["name"], list(self.get_messages()))
 
     def export_current_chat(self):
-        file_dialog = Gtk.FileDialog(initial_name=f"{self.chats['selected_chat']}.json")
+        file_dialog = Gtk.FileDialog(initial_name=f"{self.chats['chats'][self.chats['selected_chat']]['name']}.json")
         file_dialog.save(parent=self, cancellable=None, callback=self.on_export_current_chat)
 
-    def on_chat_imported(self, file_dialog, result):
-        file = file_dialog.open_finish(result)
-        stream = file.read(None)
-        data_stream = Gio.DataInputStream.new(stream)
-        data, _ = data_stream.read_until('\0', None)
-        data = json.loads(data)
-        chat_name = list(data.keys())[0]
-        chat_content = data[chat_name]
-        self.chats['chats'][chat_name] = chat_content
-        self.update_chat_list()
+    def on_export_all_chats(self, file_dialog, result):
+        try: file = file_dialog.save_finish(result)
+        except: return
+        chats = {"chats": {chat_id: dict(chat) for chat_id, chat in self.chats["chats"].items()}}
+        self.start_transfer(_("Exporting chats..."), chat_archive.export_archive, self.on_all_chats_exported, file.get_path(), chats)
+
+    def export_all_chats(self):
+        file_dialog = Gtk.FileDialog(initial_name=_("Alpaca Chats") + ".zip")
+        file_dialog.save(parent=self, cancellable=None, callback=self.on_export_all_chats)
+
+    def on_chats_imported(self, changes):
+        if isinstance(changes, Exception):
+            self.show_toast("error", 9, self.main_overlay)
+            return
+        for chat_id, chat in changes:
+            if chat_id in self.chats["chats"]:
+                self.chats["chats"][chat_id] = chat
+                self.chat_items[chat_id].set_property("last_activity", chat["last_activity"])
+                self.sort_chat_item(chat_id)
+                if chat_id == self.chats["selected_chat"]: self.load_history_into_chat()
+            else:
+                self.chats["chats"][chat_id] = chat
+                self.add_chat_item(chat_id, False)
         self.save_history()
         self.show_toast("good", 3, self.main_overlay)
 
+    def on_chat_imported(self, file_dialog, result):
+        try: file = file_dialog.open_finish(result)
+        except: return
+        chats = {"chats": {chat_id: dict(chat) for chat_id, chat in self.chats["chats"].items()}}
+        self.start_transfer(_("Importing chats..."), chat_archive.import_file, self.on_chats_imported, file.get_path(), chats)
+
     def import_chat(self):
-        file_dialog = Gtk.FileDialog(default_filter=self.file_filter_json)
+        file_dialog = Gtk.FileDialog(default_filter=self.file_filter_chats)
         file_dialog.open(self, None, self.on_chat_imported)
 
     def switch_run_on_background(self):
@@ -898,19 +1450,31 @@ class AlpacaWindow(Adw.ApplicationWindow):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        GtkSource.init()
+        if os.getenv("ALPACA_DIAGNOSTICS"): diagnostics.enable()
+        self.diagnostics_counters()
         self.set_help_overlay(self.shortcut_window)
         self.get_application().set_accels_for_action("win.show-help-overlay", ['<primary>slash'])
         self.get_application().create_action('new_chat', lambda *_: self.new_chat(), ['<primary>n'])
         self.get_application().create_action('clear', lambda *_: dialogs.clear_chat(self), ['<primary>e'])
+        self.get_application().create_action('compare', lambda *_: dialogs.compare_models(self), ['<primary>m'])
+        self.get_application().create_action('diagnostics', lambda *_: self.show_diagnostics(), ['<primary><shift>d'])
         self.get_application().create_action('send', lambda *_: self.send_message(self), ['Return'])
         self.get_application().create_action('export_current_chat', lambda *_: self.export_current_chat())
+        self.get_application().create_action('export_all_chats', lambda *_: self.export_all_chats())
         self.get_application().create_action('import_chat', lambda *_: self.import_chat())
         self.add_chat_button.connect("clicked", lambda button : self.new_chat())
+        self.manage_models_dialog.connect("closed", self.manage_models_closed)
+        self.pool_size_spin.get_adjustment().set_upper(os.cpu_count() or 1)
+        self.chat_list_model = Gio.ListStore.new(ChatItem)
+        self.chat_list_box.bind_model(self.chat_list_model, self.create_chat_row)
+        drop_target = Gtk.DropTarget.new(Gdk.FileList, Gdk.DragAction.COPY)
+        drop_target.connect("drop", self.on_image_dropped)
+        self.add_controller(drop_target)
 
         self.remote_connection_entry.connect("entry-activated", lambda entry : entry.set_css_classes([]))
         self.remote_connection_switch.connect("notify", lambda pspec, user_data : self.connection_switched())
         self.background_switch.connect("notify", lambda pspec, user_data : self.switch_run_on_background())
+        self.connect("notify::visible", lambda window, pspec : self.visibility_changed())
         if os.path.exists(os.path.join(self.config_dir, "server.json")):
             with open(os.path.join(self.config_dir, "server.json"), "r") as f:
                 data = json.load(f)
@@ -923,6 +1487,14 @@ class AlpacaWindow(Adw.ApplicationWindow):
                 self.temperature_spin.set_value(data['model_tweaks']['temperature'])
                 self.seed_spin.set_value(data['model_tweaks']['seed'])
                 self.keep_alive_spin.set_value(data['model_tweaks']['keep_alive'])
+                if "compare_parallel" in data: self.compare_parallel = data['compare_parallel']
+                self.compare_parallel_spin.set_value(self.compare_parallel)
+                if "idle_timeout" in data: local_instance.idle_timeout = data['idle_timeout']
+                self.idle_timeout_spin.set_value(local_instance.idle_timeout)
+                if "pool_size" in data: local_instance.pool_size = data['pool_size']
+                self.pool_size_spin.set_value(local_instance.pool_size)
+                if "latency_target" in data: model_benchmark.latency_target = data['latency_target']
+                self.latency_target_spin.set_value(model_benchmark.latency_target)
 
                 self.background_switch.set_active(self.run_on_background)
                 self.set_hide_on_close(self.run_on_background)
@@ -932,13 +1504,10 @@ class AlpacaWindow(Adw.ApplicationWindow):
                     self.remote_connection_switch.set_active(True)
                 else:
                     self.remote_connection_switch.set_active(False)
-                    connection_handler.url = f"http://127.0.0.1:{local_instance.port}"
-                    local_instance.start()
+                    self.use_local_instance(True)
         else:
-            local_instance.start()
-            connection_handler.url = f"http://127.0.0.1:{local_instance.port}"
+            self.use_local_instance(True)
             self.welcome_dialog.present(self)
-        if self.verify_connection() is False: self.connection_error()
-        self.update_list_available_models()
+        self.verify_connection(self.connection_checked)
         self.load_history()
         self.update_chat_list()